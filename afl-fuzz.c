@@ -406,6 +406,7 @@ enum {
   /* 03 */ PY_FUNC_POST_TRIM,
   /* 04 */ PY_FUNC_TRIM,
   /* 05 */ PY_FUNC_FEED,   // Information feedback
+  /* 06 */ PY_FUNC_FUZZ_BATCH,
   PY_FUNC_COUNT
 };
 
@@ -429,10 +430,16 @@ static int init_py() {
       py_functions[PY_FUNC_POST_TRIM] = PyObject_GetAttrString(py_module, "post_trim");
       py_functions[PY_FUNC_TRIM] = PyObject_GetAttrString(py_module, "trim");
       py_functions[PY_FUNC_FEED] = PyObject_GetAttrString(py_module, "get_info_feedback");  // add
+      py_functions[PY_FUNC_FUZZ_BATCH] = PyObject_GetAttrString(py_module, "fuzz_batch");
 
       for (u8 py_idx = 0; py_idx < PY_FUNC_COUNT; ++py_idx) {
         if (!py_functions[py_idx] || !PyCallable_Check(py_functions[py_idx])) {
-          if (py_idx >= PY_FUNC_INIT_TRIM && py_idx <= PY_FUNC_TRIM) {
+          if (py_idx == PY_FUNC_FUZZ_BATCH) {
+            // The batched fuzz API is optional, fuzz is used without it
+            PyErr_Clear();
+            Py_XDECREF(py_functions[py_idx]);
+            py_functions[py_idx] = NULL;
+          } else if (py_idx >= PY_FUNC_INIT_TRIM && py_idx <= PY_FUNC_TRIM) {
             // Implementing the trim API is optional for now
             if (PyErr_Occurred())
               PyErr_Print();
@@ -538,6 +545,73 @@ static void fuzz_py(char* buf, size_t buflen, char* add_buf, size_t add_buflen,
   }
 }
 
+/* Calls fuzz_batch for up to count mutants of buf. Returns a new reference
+   to the list of bytearrays it returned, or NULL if the call failed. */
+
+static PyObject* fuzz_batch_py(char* buf, size_t buflen, u32 count) {
+  PyObject *py_args, *py_value;
+
+  py_args = PyTuple_New(3);
+  py_value = PyByteArray_FromStringAndSize(buf, buflen);
+  if (!py_value) {
+    Py_DECREF(py_args);
+    fprintf(stderr, "Cannot convert argument\n");
+    return NULL;
+  }
+
+  PyTuple_SetItem(py_args, 0, py_value);
+
+  py_value = PyByteArray_FromStringAndSize("", 0);
+  if (!py_value) {
+    Py_DECREF(py_args);
+    fprintf(stderr, "Cannot convert argument\n");
+    return NULL;
+  }
+
+  PyTuple_SetItem(py_args, 1, py_value);
+
+  py_value = PyInt_FromLong(count);
+  if (!py_value) {
+    Py_DECREF(py_args);
+    fprintf(stderr, "Cannot convert argument\n");
+    return NULL;
+  }
+
+  PyTuple_SetItem(py_args, 2, py_value);
+
+  py_value = PyObject_CallObject(py_functions[PY_FUNC_FUZZ_BATCH], py_args);
+
+  Py_DECREF(py_args);
+
+  if (py_value == NULL || !PyList_Check(py_value)) {
+    if (py_value == NULL) PyErr_Print();
+    Py_XDECREF(py_value);
+    fprintf(stderr,"Call failed\n");
+    return NULL;
+  }
+
+  return py_value;
+}
+
+/* Append the statistics the Python module reports to the stats file. */
+
+static void write_py_stats(FILE* f) {
+  PyObject *py_value;
+
+  if (py_module == NULL) return;
+
+  py_value = PyObject_CallObject(py_functions[PY_FUNC_FEED], NULL);
+
+  if (py_value != NULL && PyString_Check(py_value)) {
+    fputs(PyString_AsString(py_value), f);
+  } else if (py_value == NULL) {
+    PyErr_Print();
+    fprintf(stderr, "Call failed\n");
+  }
+
+  Py_XDECREF(py_value);
+}
+
 // Information feedback
 // static u32 get_cov_py() {
 
@@ -3674,6 +3748,10 @@ static void write_stats_file(double bitmap_cvg, double stability, double eps) {
              exec_tmout, use_banner, orig_cmdline);
              /* ignore errors */
 
+#ifdef USE_PYTHON
+  write_py_stats(f);
+#endif
+
   fclose(f);
 
 }
@@ -6423,67 +6501,124 @@ python_stage:
   char* retbuf = NULL;
   size_t retlen = 0;
 
-  for (stage_cur = 0; stage_cur < stage_max; stage_cur++) {
-    struct queue_entry* target;
-    u32 tid;
-    u8* new_buf;
+  if (py_functions[PY_FUNC_FUZZ_BATCH]) {
 
-// If you want achieve the hybridization of two test cases, you can remove the annotations
-//retry_external_pick:
-    /* Pick a random other queue entry for passing to external API */
-  //  do { tid = UR(queued_paths); } while (tid == current_entry && queued_paths > 1);
+    /* Batched API: the seed is passed and parsed once per batch, and
+       mutants are run straight from the returned bytearrays. */
 
-  //  target = queue;
+    stage_cur = 0;
 
-   // while (tid >= 100) { target = target->next_100; tid -= 100; }
-    //while (tid--) target = target->next;
+    while (stage_cur < stage_max) {
+      PyObject* py_batch = fuzz_batch_py(out_buf, len,
+                                         MIN(stage_max - stage_cur, PYTHON_BATCH_SIZE));
+      Py_ssize_t py_cnt, py_i;
 
-    /* Make sure that the target has a reasonable length. */
+      /* Like a failed fuzz call, a failed batch uses up one iteration. */
 
-    //while (target && (target->len < 2 || target == queue_cur) && queued_paths > 1) {
-     // target = target -> next;
-     // splicing_with++;
-   // }
+      if (!py_batch) {
+        stage_cur++;
+        continue;
+      }
 
-    //if (!target) goto retry_external_pick;
+      py_cnt = PyList_Size(py_batch);
 
-    /* Read the additional testcase into a new buffer. */
-    //fd = open(target->fname, O_RDONLY);
-    //if (fd < 0) PFATAL("Unable to open '%s'", target->fname);
-    //new_buf = ck_alloc_nozero(target->len);
-    //ck_read(fd, new_buf, target->len, target->fname);
-    //close(fd);
+      for (py_i = 0; py_i < py_cnt && stage_cur < stage_max; py_i++, stage_cur++) {
+        PyObject* py_mutant = PyList_GetItem(py_batch, py_i);
 
-    fuzz_py(out_buf, len, "", 0, &retbuf, &retlen);
+        if (!PyByteArray_Check(py_mutant) || !PyByteArray_Size(py_mutant)) {
+          Py_DECREF(py_batch);
+          goto abandon_entry;
+        }
 
-    //ck_free(new_buf);
+        if (common_fuzz_stuff(argv, (u8*)PyByteArray_AsString(py_mutant),
+                              PyByteArray_Size(py_mutant))) {
+          Py_DECREF(py_batch);
+          goto abandon_entry;
+        }
 
-    if (retbuf) {
-      if (!retlen)
-        goto abandon_entry;
+        /* If we're finding new stuff, let's run for a bit longer, limits
+           permitting. */
 
-      if (common_fuzz_stuff(argv, retbuf, retlen)) {
-        free(retbuf);
-        goto abandon_entry;
+        if (queued_paths != havoc_queued) {
+          if (perf_score <= HAVOC_MAX_MULT * 100) {
+            stage_max  *= 2;
+            perf_score *= 2;
+          }
+
+          havoc_queued = queued_paths;
+        }
       }
 
-      /* Reset retbuf/retlen */
-      free(retbuf);
-      retbuf = NULL;
-      retlen = 0;
+      Py_DECREF(py_batch);
+
+      if (!py_cnt) stage_cur++;
+    }
+
+  } else {
+
+    for (stage_cur = 0; stage_cur < stage_max; stage_cur++) {
+      struct queue_entry* target;
+      u32 tid;
+      u8* new_buf;
+
+  // If you want achieve the hybridization of two test cases, you can remove the annotations
+  //retry_external_pick:
+      /* Pick a random other queue entry for passing to external API */
+    //  do { tid = UR(queued_paths); } while (tid == current_entry && queued_paths > 1);
+
+    //  target = queue;
+
+     // while (tid >= 100) { target = target->next_100; tid -= 100; }
+      //while (tid--) target = target->next;
+
+      /* Make sure that the target has a reasonable length. */
+
+      //while (target && (target->len < 2 || target == queue_cur) && queued_paths > 1) {
+       // target = target -> next;
+       // splicing_with++;
+     // }
+
+      //if (!target) goto retry_external_pick;
+
+      /* Read the additional testcase into a new buffer. */
+      //fd = open(target->fname, O_RDONLY);
+      //if (fd < 0) PFATAL("Unable to open '%s'", target->fname);
+      //new_buf = ck_alloc_nozero(target->len);
+      //ck_read(fd, new_buf, target->len, target->fname);
+      //close(fd);
 
-      /* If we're finding new stuff, let's run for a bit longer, limits
-         permitting. */
+      fuzz_py(out_buf, len, "", 0, &retbuf, &retlen);
 
-      if (queued_paths != havoc_queued) {
-        if (perf_score <= HAVOC_MAX_MULT * 100) {
-          stage_max  *= 2;
-          perf_score *= 2;
+      //ck_free(new_buf);
+
+      if (retbuf) {
+        if (!retlen)
+          goto abandon_entry;
+
+        if (common_fuzz_stuff(argv, retbuf, retlen)) {
+          free(retbuf);
+          goto abandon_entry;
         }
 
-        havoc_queued = queued_paths;
+        /* Reset retbuf/retlen */
+        free(retbuf);
+        retbuf = NULL;
+        retlen = 0;
+
+        /* If we're finding new stuff, let's run for a bit longer, limits
+           permitting. */
+
+        if (queued_paths != havoc_queued) {
+          if (perf_score <= HAVOC_MAX_MULT * 100) {
+            stage_max  *= 2;
+            perf_score *= 2;
+          }
+
+          havoc_queued = queued_paths;
+        }
       }
     }
+
   }
 
   new_hit_cnt = queued_paths + unique_crashes;
@@ -88,6 +88,11 @@
 
 #define HAVOC_MIN           16
 
+/* Number of mutants requested per call of the Python fuzz_batch() API,
+   if the module implements it: */
+
+#define PYTHON_BATCH_SIZE   64
+
 /* Maximum stacking for havoc-stage tweaks. The actual value is calculated
    like this: 
 
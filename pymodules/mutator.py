@@ -1,6 +1,12 @@
 # import byteconv as bc
+import binascii
 import random
-import os
+import struct
+
+try:
+	from numpy.random import default_rng
+except ImportError:
+	default_rng = None
 
 INTERSTRING_8 = [-128 & 0xff,-1 & 0xff,0 & 0xff,1 & 0xff,16 & 0xff,32 & 0xff,64 & 0xff,100 & 0xff,127 & 0xff]
 INTERSTRING_16 = [-32768 & 0xffff,-129 & 0xffff,128 & 0xffff,255 & 0xffff,256 & 0xffff,512 & 0xffff,1000 & 0xffff,1024 & 0xffff,4096 & 0xffff,32767 & 0xffff]
@@ -10,9 +16,89 @@ intersing_8 = INTERSTRING_8
 intersing_16 = INTERSTRING_8 + INTERSTRING_16
 intersing_32 = INTERSTRING_8 + INTERSTRING_16 + INTERSTRING_32
 
+# Output-size budget of the growing mutators, see set_size_budget
+size_budget_room = None
+size_budget_node = None
+size_budget_counters = {'shrunk': 0, 'redirected': 0}
+
+def set_size_budget(room, node_growth):
+	'''
+	Limits the bytes the next mutation may add: `room` to the module and
+	`node_growth` to a single node, None for no limit.
+	'''
+	global size_budget_room, size_budget_node
+	size_budget_room = room
+	size_budget_node = node_growth
+
+def growth_allowance(want, partial=True):
+	'''
+	Returns how many of `want` bytes a mutation may add within the size
+	budget, all or nothing unless `partial`. Counts how often a mutation
+	has to grow less (shrunk) or do something else instead (redirected).
+	'''
+	allowed = want
+	for limit in (size_budget_room, size_budget_node):
+		if limit is not None:
+			allowed = min(allowed, max(limit, 0))
+	if allowed < want:
+		if allowed == 0 or not partial:
+			size_budget_counters['redirected'] += 1
+			return 0
+		size_budget_counters['shrunk'] += 1
+	return allowed
+
+# Pool of random 32-bit words for UR and friends, refilled in bulk, see seed_random_pool
+RANDOM_POOL_SIZE = 4096
+
+random_pool = []
+random_generator = None
+
+def seed_random_pool(seed=None):
+	'''
+	Starts a new stream of random words and bytes, the same for the same
+	`seed`: from a NumPy `Generator` if NumPy provides one, from a
+	`random.Random` otherwise.
+	'''
+	global random_generator
+	if default_rng is not None:
+		random_generator = default_rng(seed)
+	else:
+		random_generator = random.Random(seed)
+	del random_pool[:]
+
+def random_bits_bytes(n):
+	'''Returns n bytes of `random.Random.getrandbits` output.'''
+	bits = random_generator.getrandbits(8 * n)
+	if hasattr(bits, 'to_bytes'):
+		return bits.to_bytes(n, 'big')
+	return binascii.unhexlify('%0*x' % (2 * n, bits))
+
+def refill_random_pool():
+	if default_rng is not None:
+		words = random_generator.integers(0, 1 << 32, RANDOM_POOL_SIZE, dtype='uint32').tolist()
+	else:
+		words = struct.unpack('>%dI' % RANDOM_POOL_SIZE, random_bits_bytes(4 * RANDOM_POOL_SIZE))
+	random_pool.extend(words)
+
+seed_random_pool()
+
 def UR(limit):
-	r = random.randint(0, limit - 1)
-	return r
+	'''Returns a random int in [0, limit), for a limit of up to 2^32.'''
+	try:
+		word = random_pool.pop()
+	except IndexError:
+		refill_random_pool()
+		word = random_pool.pop()
+	# scale the word down instead of a modulo, biased by at most limit / 2^32
+	return (word * limit) >> 32
+
+def URBYTES(n):
+	'''Returns a bytearray of n random bytes, from the stream UR draws from.'''
+	if n <= 0:
+		return bytearray()
+	if default_rng is not None:
+		return bytearray(random_generator.bytes(n))
+	return bytearray(random_bits_bytes(n))
 	
 def URBYTE():
 	r = UR(0x100)
@@ -36,7 +122,7 @@ def mutate_case_0(buf):	 # FLIP_BIT
 	
 def mutate_case_1(buf):	 # SET_BYTE_INTER_VALUE
 	buf_len = len(buf)
-	buf[UR(buf_len)] = random.choice(intersing_8) & 0xff
+	buf[UR(buf_len)] = intersing_8[UR(len(intersing_8))] & 0xff
 	fix_len = len(buf) - buf_len
 	return buf, fix_len
 	
@@ -44,7 +130,7 @@ def mutate_case_2(buf):	 # SET_WORD_INTER_VALUE
 	buf_len = len(buf)
 	if(buf_len < 2):
 		return buf, 0
-	int16 = random.choice(intersing_16)
+	int16 = intersing_16[UR(len(intersing_16))]
 	int16_0 = int16 & 0xff
 	int16_1 = (int16 >> 8) & 0xff
 	# print "%x,%x,%x" % (int16,int16_0,int16_1)
@@ -62,7 +148,7 @@ def mutate_case_3(buf):	 # SET_DWORD_INTER_VALUE
 	buf_len = len(buf)
 	if(buf_len < 4):
 		return buf, 0
-	int32 = random.choice(intersing_32)
+	int32 = intersing_32[UR(len(intersing_32))]
 	int32_0 = int32 & 0xff
 	int32_1 = (int32 >> 8) & 0xff
 	int32_2 = (int32 >> 16) & 0xff
@@ -229,8 +315,11 @@ def mutate_case_11(buf):   # Insert bytes at random position (40%)
 	if(buf_len < 4):
 		return buf, 0
 	index = UR(buf_len - 1)
-	insert_byte_len = int(0.4 * buf_len)
-	inserted_byte = bytearray(os.urandom(insert_byte_len))
+	insert_byte_len = growth_allowance(int(0.4 * buf_len))
+	if insert_byte_len == 0:
+		# no room to grow, overwrite with random bytes instead
+		return mutate_case_14(buf)
+	inserted_byte = URBYTES(insert_byte_len)
 	buf[index:index] = inserted_byte
 	fix_len = len(buf) - buf_len
 	return buf, fix_len
@@ -241,7 +330,7 @@ def mutate_case_12(buf):   # Remove bytes at random position (25%)
 		return buf, 0
 	index = UR(buf_len - 1)
 	delete_bytes_len = int(0.25 * buf_len)
-	buf[index:index + random.randint(0, delete_bytes_len)] = b''
+	buf[index:index + UR(delete_bytes_len + 1)] = b''
 	fix_len = len(buf) - buf_len
 	return buf, fix_len
 
@@ -253,7 +342,14 @@ def mutate_case_13(buf):   # Clone bytes at random position (75%)
 	clone_bytes_len = int(0.75 * buf_len)
 	if buf_len - index < 1:
 		clone_bytes_len = buf_len
-	buf[index:index] = buf[index:clone_bytes_len]
+	cloned_bytes = buf[index:clone_bytes_len]
+	if len(cloned_bytes) > 0:
+		allowed = growth_allowance(len(cloned_bytes))
+		if allowed == 0:
+			# no room to grow, overwrite with a part of the buffer instead
+			return mutate_case_15(buf)
+		cloned_bytes = cloned_bytes[:allowed]
+	buf[index:index] = cloned_bytes
 	fix_len = len(buf) - buf_len
 	return buf, fix_len
 
@@ -262,8 +358,8 @@ def mutate_case_14(buf):   # Overwrite bytes with 50% randomly generated extra b
 	if(buf_len < 10):
 		return buf, 0
 	overwrite_byte_len = int(0.5 * buf_len)
-	overwrite_byte = bytearray(os.urandom(overwrite_byte_len))
-	start_index = random.randint(0, buf_len - overwrite_byte_len)
+	overwrite_byte = URBYTES(overwrite_byte_len)
+	start_index = UR(buf_len - overwrite_byte_len + 1)
 	buf[start_index:start_index + overwrite_byte_len] = overwrite_byte
 	fix_len = len(buf) - buf_len
 	return buf, fix_len
@@ -273,8 +369,8 @@ def mutate_case_15(buf):   # Overwrite bytes with a randomly selected part (40%)
 	if(buf_len < 10):
 		return buf, 0
 	overwrite_bytes_len = int(0.4 * buf_len)
-	index = random.randint(0, buf_len - overwrite_bytes_len)
-	start_index = random.randint(0, buf_len - overwrite_bytes_len)
+	index = UR(buf_len - overwrite_bytes_len + 1)
+	start_index = UR(buf_len - overwrite_bytes_len + 1)
 	overwrite_bytes = buf[index:index + overwrite_bytes_len]
 	buf[start_index:start_index + overwrite_bytes_len] = overwrite_bytes
 	fix_len = len(buf) - buf_len
@@ -285,16 +381,19 @@ def mutate_case_15(buf):   # Overwrite bytes with a randomly selected part (40%)
 # Structure Mutation Operation
 # RepeatField Node Mutate
 def mutate_case_structure_clone(node):     # Clone and Insert a structure data (RepeatField) 
-	nodeData = random.choice(node.data)
-	lens, data, _ = node.type.field.from_raw(None, nodeData.rebuild())
-	node.data.append(data)
+	nodeData = node.data[UR(len(node.data))]
+	lens = len(nodeData.rebuild())
+	if growth_allowance(lens, partial=False) == 0 and lens > 0:
+		# no room for the clone, remove one instead
+		return mutate_case_structure_sub(node)
+	node.data.append(nodeData.clone())
 	return lens
 
 def mutate_case_structure_sub(node):       # Remove a structure data randomly (RepeatField) 
 	if (len(node.data) < 4):
 		return 0
-	nodeData = random.choice(node.data)
-	lens, _, _ = node.type.field.from_raw(None, nodeData.rebuild())
+	nodeData = node.data[UR(len(node.data))]
+	lens = len(nodeData.rebuild())
 	node.data.remove(nodeData)
 	return -lens
 
@@ -302,29 +401,36 @@ def mutate_case_structure_sub(node):       # Remove a structure data randomly (R
 def mutate_case_structure_add(node, add_node):       # Add a structure data (RepeatField) 
 	if (len(add_node.data) < 1):
 		return 0
-	addNodeData = random.choice(add_node.data)
-	if type(addNodeData) == int:
+	addNodeData = add_node.data[UR(len(add_node.data))]
+	if not hasattr(addNodeData, 'clone'):
 		return 0
-	lens, data, _ = add_node.type.field.from_raw(None, addNodeData.rebuild())
-	node.data.append(data)
+	lens = len(addNodeData.rebuild())
+	if growth_allowance(lens, partial=False) == 0 and lens > 0:
+		# no room for the new one, remove one instead
+		return mutate_case_structure_sub(node)
+	node.data.append(addNodeData.clone())
 	return lens
 
 
 # RepeatField subfield Int Mutate
 def muate_case_int_add(node):              # Add a random int value (0 ~ 10)
 	node_len = len(node.data)
-	num = random.randint(1, 10)
+	# values up to 10 take one byte each
+	num = growth_allowance(1 + UR(10))
+	if num == 0:
+		# no room to grow, remove a value instead
+		return mutate_case_int_sub(node)
 	for _ in range(num):
-		random_value = random.randint(0, 10)
-		random_index = random.randint(0, node_len)
+		random_value = UR(11)
+		random_index = UR(node_len + 1)
 		node.data.insert(random_index, random_value)
 	fix_len = len(node.data) - node_len
 	return fix_len
 
 def mutate_case_int_clone(node):          # Clone and Insert a random int value 
 	node_len= len(node.data)
-	nodeData = random.choice(node.data)
-	index = random.randint(0, node_len)
+	nodeData = node.data[UR(len(node.data))]
+	index = UR(node_len + 1)
 	node.data.insert(index, nodeData)
 	fix_len = len(node.data) - node_len
 	return fix_len
@@ -333,7 +439,7 @@ def mutate_case_int_sub(node):            # Remove a random int value
 	node_len = len(node.data)
 	if (len(node.data) < 4):
 		return 0
-	node.data.remove(random.choice(node.data))
+	node.data.remove(node.data[UR(len(node.data))])
 	fix_len = len(node.data) - node_len
 	return fix_len
 
@@ -342,22 +448,22 @@ def mutate_case_int_sub(node):            # Remove a random int value
 # RepeatField subfield (UnsignedLeb128Field, SignedLeb128Field, UIntNField) Mutate
 def mutate_case_unsignedint_replace(node):      # Replace with a random unsignedint value (0 ~ 2 ^ 7)
 	node_len = len(node.data)
-	value = random.randint(0, 2 ^ 7)
-	index = random.randint(0, node_len - 1)
+	value = UR((2 ^ 7) + 1)
+	index = UR(node_len)
 	node.data[index] = value
 	return 0
 	
 def mutate_case_signedint_replace(node):        # Replace with a random signedint value (-1 ~ 2 ^ 7)
 	node_len = len(node.data)
-	value = random.randint(-1, 2 ^ 7)
-	index = random.randint(0, node_len - 1)
+	value = -1 + UR((2 ^ 7) + 2)
+	index = UR(node_len)
 	node.data[index] = value
 	return 0
 
 def mutate_case_uintn_replace(node):        # Replace with a random uintn value (0 ~ 2 ^ 8)
 	node_len= len(node.data)
-	value = random.randint(0, 2 ^ 8)
-	index = random.randint(0, node_len - 1)
+	value = UR((2 ^ 8) + 1)
+	index = UR(node_len)
 	node.data[index] = value
 	return 0
 
@@ -365,21 +471,18 @@ def mutate_case_uintn_replace(node):        # Replace with a random uintn value
 
 # UnsignedLeb128Field Mutate
 def mutate_case_unsignedlebint_replace(node):   # Replace with a random uintn value (0 ~ 2 ^ 7)
-	value = random.randint(0, 2 ^ 7)
-	node.data = value
-	return 0
+	value = UR((2 ^ 7) + 1)
+	return node.set_data(value)
 
 # SignedLeb128Field Mutate
 def mutate_case_signedlebint_replace(node):     # Replace with a random uintn value (0 ~ 2 ^ 7)
-	value = random.randint(-1, 2 ^ 7)
-	node.data = value
-	return 0
+	value = -1 + UR((2 ^ 7) + 2)
+	return node.set_data(value)
 
 # UIntNField Mutate
 def mutate_case_uintnfield_replace(node):      # Replace with a random uintn value (0 ~ 2 ^ 8)
-	value = random.randint(0, 2 ^ 8)
-	node.data = value
-	return 0
+	value = UR((2 ^ 8) + 1)
+	return node.set_data(value)
 
 
 
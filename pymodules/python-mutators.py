@@ -19,76 +19,490 @@ from __future__ import print_function, absolute_import, division, unicode_litera
 from collections import namedtuple
 from .wasm.modtypes import *
 from .wasm.opcodes import OPCODE_MAP
-from .wasm.compat import byte2int
+from .wasm.compat import byte2int, integer_types
 from .wasm.types import *
+from .wasm.piecetable import PieceTable
+from .wasm.lrucache import LRUCache
 from .mutator import *
 from .weighted_choice import *
 from .wasm_insn_op import *
+from .workers import WorkerPool
 import random
-import binascii
+import bisect
+import hashlib
+import os
 
 
 # Global Definition
 NODE_WEIGHT_LIST = [('FirstLevel', 1), ('SecondLevel', 1), ('ThirdLevel', 1), ('FourLevel', 1), ('OtherLevel', 1)] 
 NODE_LEVEL_LIST = ['FirstLevel', 'SecondLevel', 'ThirdLevel', 'FourLevel', 'OtherLevel'] 
+NODE_TYPE_LIST = ['BytesField', 'RepeatField', 'UnsignedLeb128Field', 'SignedLeb128Field', 'UIntNField']
 EPSILON = 0.1
 
+# Parse tree cache (LRU), bounded by the estimated memory footprint of its entries
+PARSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PARSE_CACHE_NODE_COST = 470     # measured footprint of one parse tree node and its value in bytes
+PARSE_CACHE_NODE_SIZE = 4       # rough input bytes per parse tree node, for sections not yet decoded
+PARSE_CACHE_TYPING_COST = 48    # measured footprint of the function contexts and their stack states per input byte
+
+# Split seeds into sections and decode only those a mutation lands in
+LAZY_SECTIONS = True
+
+# Apply byte mutations of code/data payloads to the flat seed, see ParsedSeed.patch_bytes
+FLAT_BYTE_MUTATIONS = True
+FLAT_LENGTH_FIELDS = {Section: 'payload_len', FunctionBody: 'body_size', DataSegment: 'size'}
+
+# Write mutated LEB128 values into the flat seed in their original width, see ParsedSeed.patch_leb
+PADDED_LEB_MUTATIONS = False
+
+# Insert instructions typed to the operand stack at the insertion point, see wasm_insn_op.typedInstructions
+TYPED_INSTRUCTIONS = True
+
+# Mutate in this many forked worker processes while the target runs, see workers.WorkerPool
+MUTATOR_WORKERS = int(os.environ.get('AFL_PYTHON_WORKERS', '0'))
+MUTATOR_RING_SIZE = 16 * 1024 * 1024
+
+worker_pool = None
+
+# Candidates tried by the structural trimmer per queue entry, see Trimmer
+TRIM_MAX_STEPS = 1024
+
+# Bytes a mutation may grow the module to (AFL's MAX_FILE) and a node by, see mutator.set_size_budget
+MAX_MODULE_SIZE = int(os.environ.get('AFL_PYTHON_MAX_SIZE', str(1024 * 1024)))
+MAX_NODE_GROWTH = int(os.environ.get('AFL_PYTHON_MAX_GROWTH', str(16 * 1024)))
+
 adaptive_epsilon_greedy = AdapativeEpsilonGreedy(len(NODE_LEVEL_LIST), EPSILON)
 adaptive_thompson_sampler = AdapativeThompsonSampling(len(NODE_LEVEL_LIST))
 
 
-# Wasm File Parser => Parse Tree
-def parser(buf):
-    hdr = ModuleHeader()
-    hdr_len, hdr_data, _ = hdr.from_raw(None, buf)
-    buf = buf[hdr_len:]
-    sec_list = []
-    sec_data_list = []
+# Extract different levels of leaf nodes
+# sections with a `code` or `data` field, see in_code_or_data
+CODE_OR_DATA_SECTIONS = frozenset(['CodeSection', 'DataSection'])
+
+
+def in_code_or_data(node):
+    """Whether `code` or `data` is a component of the node's path."""
+    if node.section not in CODE_OR_DATA_SECTIONS:
+        return False
+    while node is not None:
+        if node.index is None and node.name in ('code', 'data'):
+            return True
+        node = node.parent
+    return False
+
+
+# leaf level buckets by node depth (the number of path components minus one)
+NODE_LEVEL_BY_DEPTH = {1: 'FirstLevel', 2: 'SecondLevel', 4: 'ThirdLevel', 5: 'FourLevel'}
+
 
-    while buf:
+Classified = namedtuple('Classified', 'nodes fields levels')
+
+
+# Classify the nodes of a parse tree by type and by leaf level
+def classify_nodes(nodes):
+    allField = dict((name, []) for name in NODE_TYPE_LIST)
+    allNode = dict((name, []) for name in NODE_LEVEL_LIST)
+
+    for node in nodes:
+        if in_code_or_data(node):
+            allField['BytesField'].append(node)
+        # if isinstance(node.type, BytesField):
+        #     allField['BytesField'].append(node)
+        if isinstance(node.type, RepeatField) and not isinstance(node.type, BytesField):
+            allField['RepeatField'].append(node)
+        if isinstance(node.type, SignedLeb128Field):
+            allField['SignedLeb128Field'].append(node)
+        if isinstance(node.type, UnsignedLeb128Field):
+            allField['UnsignedLeb128Field'].append(node)
+        if isinstance(node.type, UIntNField):
+            allField['UIntNField'].append(node)
+
+        if isinstance(node.type, StructureMeta) or isinstance(node.type, InitExpr):
+            continue
+        if node.depth > 5:
+            allNode['OtherLevel'].append(node)
+        elif node.depth in NODE_LEVEL_BY_DEPTH:
+            allNode[NODE_LEVEL_BY_DEPTH[node.depth]].append(node)
+
+    return Classified(nodes, allField, allNode)
+
+
+class BodyRecord(object):
+    """
+    A function body left out of the nodes of a section split by
+    `SectionRecord.decode`. It keeps no nodes of its own, there is one
+    per body and the caller collects them.
+    """
+    __slots__ = ('data', 'parent', 'index', 'size', 'decoded')
+
+    def __init__(self, data, parent, index):
+        self.data = data
+        self.parent = parent
+        self.index = index
+        self.size = data.get_raw_length()
+        self.decoded = False
+
+    def classify(self):
+        """Decodes the body and returns its `Classified` nodes."""
+        self.decoded = True
+        return classify_nodes(self.data.get_all_nodes(self.parent, self.index))
+
+
+class SectionRecord(object):
+    """
+    A section of the input as split off by `split_sections`. It is decoded
+    into a parse tree on demand and goes out as its original bytes as long
+    as that has not happened. Split, function bodies in it that are not
+    decoded yet are left to `parts` of their own.
+    """
+    def __init__(self, sec_id, payload_len, raw, offs):
+        self.id = sec_id
+        self.payload_len = payload_len
+        self.raw = raw
+        self.offs = offs
+        # bytes not in `parts`
+        self.size = len(raw)
+        self.parts = []
+        self.sec = None
+        self.data = None
+        self.nodes = None
+        self.fields = None
+        self.levels = None
+
+    @property
+    def decoded(self):
+        return self.levels is not None
+
+    def decode(self, split=False):
+        if self.levels is not None:
+            return
         sec = Section()
-        sec_len, sec_data, _ = sec.from_raw(None, buf)
-        # print("[+] len ",sec_len)
-        sec_list.append(sec)
-        sec_data_list.append(sec_data)
-        buf = buf[sec_len:]
-    
-    buf_new = hdr.rebuild(hdr_data)
+        try:
+            sec_len, sec_data, _ = sec.from_raw(None, self.raw)
+        except Exception:
+            sec_len = None
+        if sec_len != len(self.raw):
+            # malformed, keep it opaque: nothing to mutate, original bytes out
+            self.nodes, self.fields, self.levels = classify_nodes([])
+            return
+        self.sec, self.data = sec, sec_data
+        lazy = [] if split else None
+        nodes = sec_data.get_all_nodes(lazy=lazy)
+        if lazy:
+            self.parts = [BodyRecord(*x) for x in lazy]
+            self.size -= sum(part.size for part in self.parts)
+        self.nodes, self.fields, self.levels = classify_nodes(nodes)
 
-    return buf_new, sec_list, sec_data_list
+    def rebuild_into(self, out):
+        if self.data is None:
+            out += self.raw
+        elif not self.data._dirty and self.data._cache is not None:
+            out += self.data._cache
+        else:
+            buf = bytearray()
+            self.sec.rebuild_into(self.data, buf)
+            out.add(buf, stable=True)
 
 
-# Extract different levels of leaf nodes
-def node_path(node):
-    path = ''
-    while True:
-        s = node.name
+def split_sections(buf):
+    """
+    Splits a module into its header and a list of `SectionRecord`, reading
+    no more than the id and length of each section. Returns the module as
+    a read-only view, the serialized header and the records.
+    """
+    raw = memoryview(bytes(buf))
+    hdr = ModuleHeader()
+    offs, hdr_data, _ = hdr.from_raw(None, raw)
+    id_field = VarUInt7Field()
+    len_field = VarUInt32Field()
+    records = []
+    while offs < len(raw):
+        id_len, sec_id, _ = id_field.from_raw(None, raw, offs)
+        len_len, payload_len, _ = len_field.from_raw(None, raw, offs + id_len)
+        end = offs + id_len + len_len + payload_len
+        records.append(SectionRecord(sec_id, payload_len, raw[offs:end], offs))
+        offs = end
+    return raw, hdr.rebuild(hdr_data), records
+
+
+class LazyLevels(object):
+    """
+    Leaf nodes by level over sections and function bodies decoded on demand.
+    One that has not been decoded yet is weighed by an estimate of its nodes
+    on a level, taken from the node density of those decoded so far. Once a
+    pick lands in it, it is decoded and the pick is repeated with its exact
+    count.
+    """
+    def __init__(self, records):
+        self.records = records
+        # nodes by level of the sections and bodies decoded so far
+        self.nodes = dict((name, []) for name in NODE_LEVEL_LIST)
+        self.counted = set()
+        self.decoded_size = 0
+        self.undecoded_size = sum(record.size for record in records)
+        self.layout()
+
+    def layout(self):
+        """Lines up the sections and the bodies of decoded ones by size."""
+        self.units = []
+        self.ends = []
+        end = 0
+        for record in self.records:
+            for unit in [record] + record.parts:
+                end += unit.size
+                self.units.append(unit)
+                self.ends.append(end)
+
+    def count(self, unit):
+        """Decodes a section or body and adds its nodes."""
+        size = unit.size
+        if isinstance(unit, BodyRecord):
+            levels = unit.classify().levels
+        else:
+            unit.decode(split=True)
+            levels = unit.levels
+        self.counted.add(unit)
+        for name in NODE_LEVEL_LIST:
+            self.nodes[name] += levels[name]
+        # the bytes of its bodies stay undecoded
+        self.decoded_size += unit.size
+        self.undecoded_size -= unit.size
+        if unit.size != size:
+            self.layout()
+
+    def uncounted(self):
+        """Picks a section or body not decoded yet, weighed by its size."""
+        while True:
+            i = bisect.bisect_right(self.ends, random.random() * self.ends[-1])
+            unit = self.units[min(i, len(self.units) - 1)]
+            if unit not in self.counted:
+                return unit
+
+    def density(self, level):
+        # none measured yet: the prior, so undecoded parts are still looked
+        # into before the level counts as empty
+        if self.decoded_size == 0 or not self.nodes[level]:
+            return 1.0 / PARSE_CACHE_NODE_SIZE
+        return len(self.nodes[level]) / self.decoded_size
+
+    def choose(self, level):
+        while True:
+            nodes = self.nodes[level]
+            undecoded = self.undecoded_size * self.density(level) if self.undecoded_size > 0 else 0
+            total = len(nodes) + undecoded
+            if total <= 0:
+                return None
+            pick = random.random() * total
+            if pick < len(nodes):
+                return nodes[int(pick)]
+            self.count(self.uncounted())
+
+
+class ParsedSeed(object):
+    """
+    A parsed and classified input, as kept in the parse tree cache. The tree
+    is mutated in place and rolled back through `journal` after each use.
+
+    With `lazy`, sections are only decoded once a mutation picks a node in
+    them (see `LazyLevels`); `levels` then is a `LazyLevels`.
+    """
+    def __init__(self, buf, lazy=None):
+        if lazy is None:
+            lazy = LAZY_SECTIONS
+        self.raw, self.hdr, self.sections = split_sections(buf)
+        self.journal = Journal()
+        # offsets into `raw` by node, see `node_offset`
+        self.offsets = {}
+        self.element_offsets = {}
+        # output of a mutation applied by `patch_bytes`
+        self.patched = None
+        # see `function_context`
+        self.module = None
+        self.functions = {}
+        if lazy:
+            self.levels = LazyLevels(self.sections)
+            node_count = len(buf) // PARSE_CACHE_NODE_SIZE
+        else:
+            self.levels = self.merge('levels', NODE_LEVEL_LIST)
+            node_count = len(self.nodes)
+        # the seed is held about four times over: as parsed values and as
+        # serialized bytes cached by Structure.rebuild on each tree level;
+        # `functions` at most holds a context and stack states per body
+        self.cost = (4 + PARSE_CACHE_TYPING_COST) * len(buf) + node_count * PARSE_CACHE_NODE_COST
+
+    def classified(self):
+        """Decodes all sections and function bodies, lists their `Classified` nodes."""
+        out = []
+        for record in self.sections:
+            record.decode()
+            out.append(Classified(record.nodes, record.fields, record.levels))
+            for part in record.parts:
+                out.append(part.classify())
+        return out
+
+    def merge(self, attr, keys):
+        """Decodes everything and concatenates the classified nodes."""
+        merged = dict((name, []) for name in keys)
+        for classified in self.classified():
+            for name in keys:
+                merged[name] += getattr(classified, attr)[name]
+        return merged
+
+    @property
+    def nodes(self):
+        nodes = []
+        for classified in self.classified():
+            nodes += classified.nodes
+        return nodes
+
+    @property
+    def fields(self):
+        return self.merge('fields', NODE_TYPE_LIST)
+
+    def rebuild_into(self, out):
+        """Serializes all sections into the `PieceTable` `out`."""
+        for record in self.sections:
+            record.rebuild_into(out)
+
+    def node_offset(self, node):
+        """Obtains the offset of an unmodified node's value in the seed."""
+        offs = self.offsets.get(node)
+        if offs is not None:
+            return offs
         parent = node.parent
-        path += s
-        if parent == None:
-            return path
-        if type(parent.data) == list:
-            index = parent.data.index(node.data)
-            path = path+'['+str(index)+']'+'.'
+        if parent is None:
+            offs = next(r.offs for r in self.sections if r.data is node.data)
+        elif node.index is not None:
+            elements = self.element_offsets.get(parent)
+            if elements is None:
+                elements = [0]
+                for x in parent.data:
+                    elements.append(elements[-1] + x.get_raw_length())
+                self.element_offsets[parent] = elements
+            offs = self.node_offset(parent) + elements[node.index]
         else:
-            path = path + '.'
-        node = parent
+            field_name = node.name
+            if isinstance(node.data, StructureData):
+                # nested structures are named after their type's last use
+                field_name = next(
+                    cur_field_name for cur_field_name, cur_field in parent.data._meta.fields
+                    if getattr(parent.data, cur_field_name) is node.data
+                )
+            offs = self.node_offset(parent) + parent.data.get_raw_field_offset(field_name)
+        self.offsets[node] = offs
+        return offs
+
+    def patch_bytes(self, node, value, length=None):
+        """
+        Replaces the bytes of an unmodified node by `value` in a copy of the
+        seed and re-encodes the length fields enclosing it, instead of
+        serializing the mutated tree. The result is left in `patched`.
+        `length` is the node's length in the seed, if it is not a byte field.
+
+        This matches a rebuild of the mutated tree as long as the seed itself
+        rebuilds to the same bytes; other fields are never re-encoded here.
+        """
+        start = self.node_offset(node)
+        end = start + (len(node.data) if length is None else length)
+        # (offset, end, bytes) in the seed, innermost last
+        edits = [(start, end, value)]
+        delta = len(value) - (end - start)
+        ancestor = node.parent
+        while ancestor is not None and delta != 0:
+            field_name = FLAT_LENGTH_FIELDS.get(ancestor.type)
+            if field_name is not None:
+                data = ancestor.data
+                offs = self.node_offset(ancestor) + data.get_raw_field_offset(field_name)
+                width = data._decoder_meta['lengths'][field_name]
+                encoded = bytearray()
+                write_unsigned_leb128(encoded, getattr(data, field_name) + delta)
+                edits.append((offs, offs + width, encoded))
+                delta += len(encoded) - width
+            ancestor = ancestor.parent
+
+        out = PieceTable()
+        pos = 0
+        for offs, end, encoded in reversed(edits):
+            out.add(self.raw, pos, offs - pos)
+            out.add(encoded, stable=True)
+            pos = end
+        out.add(self.raw, pos)
+        self.patched = out
+
+    def patch_leb(self, node, journal):
+        """
+        Writes the value a mutator set on a LEB128 node into a copy of the
+        seed, padded to the field's original width (see `patch_bytes`).
+        The parent structure is fixed up first, like on the tree path; as
+        no length changes, that can only reset the mutated field itself.
+        Returns False, leaving the tree to be fixed and serialized as usual,
+        if the value does not fit or the fixup touches other fields.
+        """
+        data = node.parent.data
+        before = [getattr(data, cur_field_name) for cur_field_name, cur_field in data._meta.fields]
+        journal.record_fields(data)
+        data._meta.get_structure().fix(data)
+        for (cur_field_name, cur_field), value in zip(data._meta.fields, before):
+            if cur_field_name != node.name and getattr(data, cur_field_name) != value:
+                return False
+        width = data._decoder_meta['lengths'][node.name]
+        encoded = encode_padded_leb128(
+            getattr(data, node.name), width, isinstance(node.type, SignedLeb128Field)
+        )
+        if encoded is None:
+            return False
+        self.patch_bytes(node, encoded, width)
+        return True
+
+    def function_context(self, node):
+        """
+        Returns the `FunctionContext` of the function body a `code` node is
+        in, or None if the sections declaring it do not decode.
+        """
+        body = node.parent
+        if body is None or body.index is None:
+            return None
+        if body.index not in self.functions:
+            if self.module is None:
+                # decoded apart from the records, which may be mutated
+                sections = []
+                try:
+                    for record in self.sections:
+                        if record.id in (SEC_TYPE, SEC_IMPORT, SEC_FUNCTION, SEC_TABLE, SEC_MEMORY, SEC_GLOBAL):
+                            sections.append(Section().from_raw(None, record.raw)[1])
+                    # the validator's types, as imported by wasm_insn_op
+                    self.module = ModuleContext(sections)
+                except Exception:
+                    self.module = False
+            try:
+                function = self.module.function(body.index, body.data) if self.module else None
+            except ValidationError:
+                function = None
+            self.functions[body.index] = function
+        return self.functions[body.index]
+
+
+parse_cache = LRUCache(PARSE_CACHE_MAX_BYTES, lambda key, seed: seed.cost)
+
+def parse_cached(buf):
+    return parse_cache.get(hashlib.md5(buf).digest(), lambda key: ParsedSeed(buf))
 
 
 # Specific mutation operation
-def RunMutate(subnode):
+def RunMutate(subnode, journal=None, seed=None):
     byte_mutators = [mutate_case_0, mutate_case_1, mutate_case_2, mutate_case_3, mutate_case_4, mutate_case_5, mutate_case_6, 
                      mutate_case_7, mutate_case_8, mutate_case_9, mutate_case_10, mutate_case_11, mutate_case_12, mutate_case_13, 
                      mutate_case_14, mutate_case_15]
     structure_mutators = [mutate_case_structure_clone, mutate_case_structure_sub]
     structure_int_mutators = [muate_case_int_add, mutate_case_int_clone, mutate_case_int_sub]
-    instruction_mutators = [insertInstruction, eraseInstruction, moveInstruction]
+    instruction_mutators = [insertInstruction, eraseInstruction, moveInstruction, replaceInstruction,
+                            wrapInstructions, duplicateBlock, retargetBranch, deleteBlock]
     ByteMutatorList = ["byte_mutators", "instruction_mutators"]
 
-    path = node_path(subnode)
-    result = path.split(".")
-    
     # TODO: The selection strategy of mutators can be optimized
+    if journal is not None:
+        subnode.save(journal)
+    subnode.make_writable()
     fix_len = 0
     if isinstance(subnode.type, SignedLeb128Field):
         fix_len = mutate_case_signedlebint_replace(subnode)
@@ -99,24 +513,33 @@ def RunMutate(subnode):
     elif isinstance(subnode.type, BytesField):
         item = random.choice(ByteMutatorList)
         if item == "byte_mutators":
-            if 'code' in result or 'data' in result:
+            if in_code_or_data(subnode):
                 if subnode.name != "overhang" and len(subnode.data) > 0:
                     bytemutate = random.choice(byte_mutators)
+                    if seed is not None and FLAT_BYTE_MUTATIONS:
+                        value, _ = bytemutate(bytearray(subnode.data))
+                        seed.patch_bytes(subnode, value)
+                        return
                     _, fix_len = bytemutate(subnode.data)
         elif item == "instruction_mutators":
-            DataLen = len(subnode.data)
-            ByteNodeData = binascii.hexlify(subnode.data).decode('utf-8')
-            insnMutate = random.choice(instruction_mutators)
-            NewByteData = insnMutate(ByteNodeData)
-            NewDataLen = len(NewByteData)
-            fix_len = NewDataLen - DataLen
+            if subnode.name == "code" and len(subnode.data) > 0:
+                insnMutate = random.choice(instruction_mutators)
+                function = None
+                if seed is not None and TYPED_INSTRUCTIONS:
+                    function = seed.function_context(subnode)
+                if seed is not None and FLAT_BYTE_MUTATIONS:
+                    value = bytearray(subnode.data)
+                    insnMutate(value, function)
+                    seed.patch_bytes(subnode, value)
+                    return
+                fix_len = insnMutate(subnode.data, function)
     elif isinstance(subnode.type, RepeatField) and not isinstance(subnode.type, BytesField):
         if len(subnode.data) > 0:
                 subnodeData = random.choice(subnode.data)
                 if isinstance(subnodeData, StructureData):
                     structuremutate = random.choice(structure_mutators)
                     fix_len = structuremutate(subnode)
-                elif type(subnodeData) == int:
+                elif isinstance(subnodeData, integer_types):
                     randomSelect = random.randint(1, 10)
                     if randomSelect >= 5:
                         structureintmutate = random.choice(structure_int_mutators)
@@ -129,14 +552,27 @@ def RunMutate(subnode):
                         elif isinstance(subnode.type.field, UIntNField):
                             fix_len = mutate_case_uintn_replace(subnode)
     
+    if (seed is not None and PADDED_LEB_MUTATIONS and
+            isinstance(subnode.type, (SignedLeb128Field, UnsignedLeb128Field)) and
+            seed.patch_leb(subnode, journal)):
+        return
+
     # fixing
-    subnode.fix_node_data_length(fix_len)
-    subnode.fix() 
+    subnode.fixup(fix_len, journal)
+
 
+def choose_node(allNode, filedName):
+    """Picks a random node of a level, or returns None if there is none."""
+    if isinstance(allNode, LazyLevels):
+        return allNode.choose(filedName)
+    filed = allNode.get(filedName)
+    if len(filed) > 0:
+        return random.choice(filed)
+    return None
 
 
 # Parse Tree-based Structure-Aware Mutation 
-def parseTreeMutate(allNode):
+def parseTreeMutate(allNode, journal=None, seed=None):
     # Strategy 1 : Randomly Selection
     filedName = random.choice(NODE_LEVEL_LIST)
 
@@ -155,10 +591,9 @@ def parseTreeMutate(allNode):
     # filedName = result.weighted_choice()
 
     if filedName == "FirstLevel":
-        filed = allNode.get(filedName)
-        if len(filed) > 0:
-            subnode = random.choice(filed)
-            RunMutate(subnode)
+        subnode = choose_node(allNode, filedName)
+        if subnode is not None:
+            RunMutate(subnode, journal, seed)
     
         # # update tuple list
         # for i in range(len(NODE_WEIGHT_LIST)):
@@ -169,28 +604,24 @@ def parseTreeMutate(allNode):
         #         NODE_WEIGHT_LIST[i] = updated_tuple
     
     if filedName == "SecondLevel":
-        filed = allNode.get(filedName)
-        if len(filed) > 0:
-            subnode = random.choice(filed)
-            RunMutate(subnode)
+        subnode = choose_node(allNode, filedName)
+        if subnode is not None:
+            RunMutate(subnode, journal, seed)
     
     if filedName == "ThirdLevel":
-        filed = allNode.get(filedName)
-        if len(filed) > 0:
-            subnode = random.choice(filed)
-            RunMutate(subnode)
+        subnode = choose_node(allNode, filedName)
+        if subnode is not None:
+            RunMutate(subnode, journal, seed)
     
     if filedName == "FourLevel":
-        filed = allNode.get(filedName)
-        if len(filed) > 0:
-            subnode = random.choice(filed)
-            RunMutate(subnode)
+        subnode = choose_node(allNode, filedName)
+        if subnode is not None:
+            RunMutate(subnode, journal, seed)
     
     if filedName == "OtherLevel":
-        filed = allNode.get(filedName)
-        if len(filed) > 0:
-            subnode = random.choice(filed)
-            RunMutate(subnode)
+        subnode = choose_node(allNode, filedName)
+        if subnode is not None:
+            RunMutate(subnode, journal, seed)
 
 
 def init(seed):
@@ -200,11 +631,22 @@ def init(seed):
     @type seed: int
     @param seed: A 32-bit random value
     '''
+    global worker_pool
     # generate a seed randomly
-    random.seed(seed)
+    seed_mutators(seed)
+    if MUTATOR_WORKERS > 0:
+        worker_pool = WorkerPool(lambda buf: mutate_seed(parse_seed(buf)),
+                                 MUTATOR_WORKERS, seed, MUTATOR_RING_SIZE, seed_mutators,
+                                 size_budget_counters)
     return 0
 
 
+def seed_mutators(seed):
+    # both the random module and the pool behind mutator.UR
+    random.seed(seed)
+    seed_random_pool(seed)
+
+
 def fuzz(buf, add_buf):
     '''
     Called per fuzzing iteration.
@@ -218,95 +660,280 @@ def fuzz(buf, add_buf):
     @rtype: bytearray
     @return: A new bytearray containing the mutated data
     '''
-    ret = bytearray(buf)
-    
-    # catch potential abnormal test cases or potential issues of parser
+    if worker_pool is not None:
+        return worker_pool.mutants(buf, 1)[0]
+    return mutate_seed(parse_seed(buf))
+
+
+def fuzz_batch(buf, add_buf, n):
+    '''
+    Called instead of fuzz, if present, for n fuzzing iterations at a time.
+
+    @type buf: bytearray
+    @param buf: The buffer that should be mutated.
+
+    @type add_buf: bytearray
+    @param add_buf: A second buffer that can be used as mutation source.
+
+    @type n: int
+    @param n: The number of mutants to generate.
+
+    @rtype: list
+    @return: A list of n new bytearrays containing the mutated data
+    '''
+    if worker_pool is not None:
+        return worker_pool.mutants(buf, n)
+    seed = parse_seed(buf)
+    return [mutate_seed(seed) for _ in range(n)]
+
+
+def parse_seed(buf):
+    # abnormal test cases or parser issues propagate to AFLFuzz, which
+    # prints the traceback on stderr
+    return parse_cached(bytearray(buf))
+
+
+def mutate_seed(seed):
+    # mutate the cached parse tree in place, classified by node types
+    # (seed.fields) and by leaf levels (seed.levels)
     try:
-        ref_new, sec_list, sec_data_list = parser(ret)
-    except Exception as e:
-        print("Exception", e)
+        # mutation operation (first version)
+        # mutate(seed.fields, seed.journal)
 
-    
-    # classify nodes based on the node types
-    allField = []
-    nodeUIntNField = []
-    nodeUnsignedLeb128Field = []
-    nodeSignedLeb128Field = []
-    nodeRepeatField = []
-    nodeBytesField = []
-
-    # classify nodes based on the leaf levels
-    allNode = []
-    firstLevelLeafNode = []
-    secondLevelLeafNode = []
-    thirdLevelLeafNode = []
-    fourLevelLeafNode = []
-    leafNode = []
-
-    # The buffer that should be mutated
-    for i in range(len(sec_list)):
-        nodes = sec_data_list[i].get_all_nodes()
-        
-        for node in nodes:
-            path = node_path(node)
-            result = path.split(".")
-            if 'code' in result or 'data' in result:
-                nodeBytesField.append(node)
-            # if isinstance(node.type, BytesField):
-            #     nodeBytesField.append(node) 
-            if isinstance(node.type, RepeatField) and not isinstance(node.type, BytesField):
-                nodeRepeatField.append(node)
-            if isinstance(node.type, SignedLeb128Field):
-                nodeSignedLeb128Field.append(node)
-            if isinstance(node.type, UnsignedLeb128Field):
-                nodeUnsignedLeb128Field.append(node)
-            if isinstance(node.type, UIntNField):
-                nodeUIntNField.append(node)
-
-        for node in nodes:
-            path = str(node_path(node))
-            result = path.split(".")
-            if len(result) == 2 and not isinstance(node.type, StructureMeta) and not isinstance(node.type, InitExpr):
-                firstLevelLeafNode.append(node)
-            if len(result) == 3 and not isinstance(node.type, StructureMeta) and not isinstance(node.type, InitExpr):
-                secondLevelLeafNode.append(node)
-            if len(result) == 5 and not isinstance(node.type, StructureMeta) and not isinstance(node.type, InitExpr):
-                thirdLevelLeafNode.append(node)
-            if len(result) == 6 and not isinstance(node.type, StructureMeta) and not isinstance(node.type, InitExpr):
-                fourLevelLeafNode.append(node)
-            if len(result) > 6 and not isinstance(node.type, StructureMeta) and not isinstance(node.type, InitExpr):
-                leafNode.append(node)
-    
-    # mutation operation (first version)
-    # allNodeField = [nodeBytesField, nodeRepeatField, nodeUnsignedLeb128Field, nodeSignedLeb128Field, nodeUIntNField]
-    # allFieldName = ['BytesField', 'RepeatField', 'UnsignedLeb128Field', 'SignedLeb128Field', 'UIntNField']
-    # allField = dict(zip(allFieldName, allNodeField))
-    # mutate(allField)
-
-    # Parse Tree-based Mutation
-    allLeafNode = [firstLevelLeafNode, secondLevelLeafNode, thirdLevelLeafNode, fourLevelLeafNode, leafNode]
-    allNodeName = ['FirstLevel', 'SecondLevel', 'ThirdLevel', 'FourLevel', 'OtherLevel']
-    allNode = dict(zip(allNodeName, allLeafNode))
-    parseTreeMutate(allNode)
- 
-    for i in range(len(sec_list)):
-        ref_new += sec_list[i].rebuild(sec_data_list[i])
-    
-    return bytearray(ref_new)
+        # Parse Tree-based Mutation
+        seed.patched = None
+        set_size_budget(MAX_MODULE_SIZE - len(seed.raw), MAX_NODE_GROWTH)
+        parseTreeMutate(seed.levels, seed.journal, seed)
+
+        if seed.patched is not None:
+            # applied to the flat seed already
+            out = seed.patched
+        else:
+            # serialize the whole module, referencing unmodified parts
+            out = PieceTable()
+            out += seed.hdr
+            seed.rebuild_into(out)
+        # assemble the pieces in a single copy
+        ref_new = out.materialize()
+    finally:
+        # roll the tree back to the pristine seed
+        seed.journal.revert()
+
+    return ref_new
+
+
+def get_info_feedback():
+    '''
+    Called by AFLFuzz whenever it writes its fuzzer_stats file.
+
+    @rtype: str
+    @return: Lines to append to the stats file, in its "name : value" format
+    '''
+    counters = dict(size_budget_counters)
+    if worker_pool is not None:
+        for name, value in worker_pool.counter_totals().items():
+            counters[name] += value
+    return str(''.join('{:<18}: {}\n'.format('size_' + name, counters[name]) for name in sorted(counters)))
+
+
+# Structure-aware trimming
+TrimUnit = namedtuple('TrimUnit', 'size cuts fields')
+
+
+class Trimmer(object):
+    """
+    Removes the structural units of a seed one at a time, largest first:
+    custom sections, function bodies along with their declaration, data
+    segments, exports and statements in function bodies (instruction ranges
+    on one nesting level that start and end with an empty operand stack).
+
+    A `TrimUnit` is the `size` it removes, the `cuts` it makes as ranges of
+    the seed and the LEB128 `fields` enclosing them as (offset, width, value,
+    decrement). Those fields are rewritten in their original width, so any
+    set of units that do not overlap applies to the seed as is; each
+    candidate is the seed with the units kept so far and the next one.
+    """
+    def __init__(self, buf):
+        self.raw, _, self.sections = split_sections(buf)
+        self.units = sorted(self.find_units(), key=lambda unit: -unit.size)[:TRIM_MAX_STEPS]
+        self.kept = []
+        self.step = 0
+
+    def find_units(self):
+        decoded = {}
+        for record in self.sections:
+            if record.id == SEC_UNK:
+                yield TrimUnit(len(record.raw), ((record.offs, record.offs + len(record.raw)),), ())
+                continue
+            try:
+                sec_len, sec_data, _ = Section().from_raw(None, record.raw)
+            except Exception:
+                continue
+            if sec_len == len(record.raw) and sec_data.id not in decoded:
+                decoded[sec_data.id] = (record, sec_data)
 
+        for sec_id in (SEC_EXPORT, SEC_DATA):
+            if sec_id in decoded:
+                datacount = decoded.get(SEC_DATA_COUNT) if sec_id == SEC_DATA else None
+                for entry_cut, fields in self.entries(*decoded[sec_id]):
+                    if datacount is not None:
+                        fields += self.count_fields(*datacount)
+                    yield TrimUnit(entry_cut[1] - entry_cut[0], (entry_cut,), tuple(fields))
+
+        if SEC_CODE in decoded:
+            bodies = list(self.entries(*decoded[SEC_CODE]))
+            declarations = list(self.entries(*decoded[SEC_FUNCTION])) if SEC_FUNCTION in decoded else []
+            if len(declarations) == len(bodies):
+                for (body_cut, body_fields), (decl_cut, decl_fields) in zip(bodies, declarations):
+                    size = body_cut[1] - body_cut[0] + decl_cut[1] - decl_cut[0]
+                    yield TrimUnit(size, (body_cut, decl_cut), tuple(body_fields + decl_fields))
+            for unit in self.statements(decoded):
+                yield unit
+
+    def field(self, data, field_name, base, decrement):
+        # read the value first, decoding a lazy structure
+        value = getattr(data, field_name)
+        offs = base + data.get_raw_field_offset(field_name)
+        width = data._decoder_meta['lengths'][field_name]
+        return (offs, width, value, decrement)
+
+    def count_fields(self, record, sec_data):
+        return [self.field(sec_data.payload, 'count', record.offs + sec_data.get_raw_field_offset('payload'), 1)]
+
+    def entries(self, record, sec_data):
+        """Yields the cut and the fields to fix up by entry of a section."""
+        payload = sec_data.payload
+        payload_offs = record.offs + sec_data.get_raw_field_offset('payload')
+        entries_name = payload._meta.fields[1][0]
+        offs = payload_offs + payload.get_raw_field_offset(entries_name)
+        for entry in getattr(payload, entries_name):
+            if isinstance(entry, integer_types):
+                length, _ = decode_leb128_run(self.raw, offs, 1)
+            else:
+                length = entry.get_raw_length()
+            fields = [
+                self.field(sec_data, 'payload_len', record.offs, length),
+                self.field(payload, 'count', payload_offs, 1),
+            ]
+            yield (offs, offs + length), fields
+            offs += length
+
+    def statements(self, decoded):
+        record, sec_data = decoded[SEC_CODE]
+        try:
+            module = ModuleContext([data for _, data in decoded.values()])
+        except Exception:
+            module = None
+        payload_len = self.field(sec_data, 'payload_len', record.offs, 0)
+        offs = record.offs + sec_data.get_raw_field_offset('payload') + sec_data.payload.get_raw_field_offset('bodies')
+        for i, body in enumerate(sec_data.payload.bodies):
+            body_size = self.field(body, 'body_size', offs, 0)
+            code_offs = offs + body.get_raw_field_offset('code')
+            offs += body.get_raw_length()
+            try:
+                function = module.function(i, body) if module is not None else None
+            except ValidationError:
+                function = None
+            for start, stop in self.statement_ranges(instruction_index(bytearray(body.code)), function):
+                size = stop - start
+                fields = (payload_len[:3] + (size,), body_size[:3] + (size,))
+                yield TrimUnit(size, ((code_offs + start, code_offs + stop),), fields)
+
+    def statement_ranges(self, index, function):
+        """
+        Yields the code ranges of the statements of a body. Without its
+        `FunctionContext`, the `block`s and `loop`s without a result.
+        """
+        nesting = index.nesting()
+        insns = index.insns
+        if function is None:
+            for i in nesting.starts:
+                if insns.op[i] in (0x02, 0x03) and insns.imm0[i] == LANG_TYPE_EMPTY:
+                    j = nesting.ends[i]
+                    yield insns.offset[i], insns.offset[j] + insns.len[j]
+            return
+
+        tops = index.stack_tops(function)
+        count = min(len(nesting.depths), len(tops))
+        for i in range(count):
+            if tops[i] != STACK_EMPTY or insns.op[i] in (0x05, 0x0b):
+                continue
+            # over whole instructions and blocks up to an empty stack again
+            j = i
+            while True:
+                j = nesting.ends.get(j, j) + 1
+                if j >= count:
+                    break
+                if tops[j] == STACK_EMPTY:
+                    yield insns.offset[i], insns.offset[j]
+                    break
+                if insns.op[j] in (0x05, 0x0b):
+                    break
+
+    def applicable(self, unit):
+        for start, stop in unit.cuts:
+            for kept in self.kept:
+                for kept_start, kept_stop in kept.cuts:
+                    if start < kept_stop and kept_start < stop:
+                        return False
+        return True
+
+    def apply(self, units):
+        """Returns the seed without the cuts of `units`, fixing up their fields."""
+        edits = {}
+        for unit in units:
+            for start, stop in unit.cuts:
+                edits[start] = (stop, b'')
+            for offs, width, value, decrement in unit.fields:
+                value = edits[offs][2] if offs in edits else value
+                edits[offs] = (offs + width, None, value - decrement)
+        out = PieceTable()
+        pos = 0
+        for offs in sorted(edits):
+            edit = edits[offs]
+            out.add(self.raw, pos, offs - pos)
+            if edit[1] is None:
+                out.add(encode_padded_leb128(edit[2], edit[0] - offs), stable=True)
+            pos = edit[0]
+        out.add(self.raw, pos)
+        return out.materialize()
+
+    def advance(self):
+        while self.step < len(self.units) and not self.applicable(self.units[self.step]):
+            self.step += 1
+        return self.step
+
+
+trimmer = None
 
 def init_trim(buf):
-    return 0
+    """
+    Called at the start of trimming a queue entry. Returns the number of
+    trimming steps, see `Trimmer`.
+    """
+    global trimmer
+    try:
+        trimmer = Trimmer(buf)
+    except Exception:
+        # not split into sections; nothing to trim structurally
+        trimmer = None
+        return 0
+    return len(trimmer.units)
 
 def trim():
-    pass
+    """Returns the next candidate: the seed without the removals kept so far and one more."""
+    return trimmer.apply(trimmer.kept + [trimmer.units[trimmer.step]])
 
 def post_trim(success):
-    return 0
+    """Keeps the removal of the last candidate on success, returns the next step."""
+    if success:
+        trimmer.kept.append(trimmer.units[trimmer.step])
+    trimmer.step += 1
+    return trimmer.advance()
 
 
 # Mutation Operation
-def mutate(allField):
+def mutate(allField, journal=None):
     byte_mutators = [mutate_case_0, mutate_case_1, mutate_case_2, mutate_case_3, mutate_case_4, mutate_case_5, mutate_case_6, 
                      mutate_case_7, mutate_case_8, mutate_case_9, mutate_case_10, mutate_case_11, mutate_case_12, mutate_case_13, 
                      mutate_case_14, mutate_case_15]
@@ -327,24 +954,28 @@ def mutate(allField):
         filed = allField.get(filedName)
         if len(filed) > 0:
             subnode = random.choice(filed)
+            if journal is not None:
+                subnode.save(journal)
+            subnode.make_writable()
             if subnode.name != "overhang" and len(subnode.data) > 0:
                 bytemutate = random.choice(byte_mutators)
                 _, fix_len = bytemutate(subnode.data)
-                subnode.fix_node_data_length(fix_len)
-                subnode.fix()
+                subnode.fixup(fix_len, journal)
 
     if filedName == "RepeatField":
         filed = allField.get(filedName)
         if len(filed) > 0:
             subnode = random.choice(filed)
+            if journal is not None:
+                subnode.save(journal)
+            subnode.make_writable()
             if len(subnode.data) > 0:
                 subnodeData = random.choice(subnode.data)
                 if isinstance(subnodeData, StructureData):
                     structuremutate = random.choice(structure_mutators)
                     fix_len = structuremutate(subnode)
-                    subnode.fix_node_data_length(fix_len)
-                    subnode.fix()
-                elif type(subnodeData) == int:
+                    subnode.fixup(fix_len, journal)
+                elif isinstance(subnodeData, integer_types):
                     fix_len = 0
                     randomSelect = random.randint(1, 10)
                     if randomSelect >= 5:
@@ -357,32 +988,34 @@ def mutate(allField):
                             fix_len = mutate_case_unsignedint_replace(subnode)
                         elif isinstance(subnode.type.field, UIntNField):
                             fix_len = mutate_case_uintn_replace(subnode)
-                    subnode.fix_node_data_length(fix_len)
-                    subnode.fix()
+                    subnode.fixup(fix_len, journal)
     
     if filedName == "UnsignedLeb128Field":
         filed = allField.get(filedName)
         if len(filed) > 0:
             subnode = random.choice(filed)
+            if journal is not None:
+                subnode.save(journal)
             fix_len = mutate_case_unsignedlebint_replace(subnode)
-            subnode.fix_node_data_length(fix_len)
-            subnode.fix()
+            subnode.fixup(fix_len, journal)
 
     if filedName == "SignedLeb128Field":
         filed = allField.get(filedName)
         if len(filed) > 0:
             subnode = random.choice(filed)
+            if journal is not None:
+                subnode.save(journal)
             fix_len = mutate_case_signedlebint_replace(subnode)
-            subnode.fix_node_data_length(fix_len)
-            subnode.fix()
+            subnode.fixup(fix_len, journal)
     
     if filedName == "UIntNField":
         filed = allField.get(filedName) 
         if len(filed) > 0:
             subnode = random.choice(filed)
+            if journal is not None:
+                subnode.save(journal)
             fix_len = mutate_case_uintnfield_replace(subnode)
-            subnode.fix_node_data_length(fix_len)
-            subnode.fix()
+            subnode.fixup(fix_len, journal)
 
 
 # Uncomment and implement the following methods if you want to use a custom
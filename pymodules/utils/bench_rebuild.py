@@ -0,0 +1,82 @@
+"""Microbenchmark for parse tree decoding (`from_raw`) and serialization (`rebuild`) throughput."""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wasm.modtypes import ModuleHeader, Section
+from wasm.types import StructureData
+
+
+def parse(raw):
+    raw = memoryview(bytes(raw))
+    hdr = ModuleHeader()
+    offs, hdr_data, _ = hdr.from_raw(None, raw)
+    sections = []
+    while offs < len(raw):
+        sec = Section()
+        sec_len, sec_data, _ = sec.from_raw(None, raw, offs)
+        sections.append((sec, sec_data))
+        offs += sec_len
+    return hdr, hdr_data, sections
+
+
+def drop_caches(value):
+    """Forgets the serialized bytes cached on every structure of a tree."""
+    if isinstance(value, StructureData):
+        value._cache = None
+        for cur_field_name, cur_field in value._meta.fields:
+            drop_caches(getattr(value, cur_field_name))
+    elif isinstance(value, list):
+        for x in value:
+            drop_caches(x)
+
+
+def rebuild(hdr, hdr_data, sections):
+    out = bytearray(hdr.rebuild(hdr_data))
+    for sec, sec_data in sections:
+        out += sec.rebuild(sec_data)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('wasm_file', type=str)
+    parser.add_argument('-n', '--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.wasm_file, 'rb') as f:
+        raw = bytearray(f.read())
+
+    start = time.time()
+    for _ in range(args.rounds):
+        hdr, hdr_data, sections = parse(raw)
+    decode = time.time() - start
+    if rebuild(hdr, hdr_data, sections) != raw:
+        print("[!] module does not round-trip, numbers are for the rebuilt size")
+
+    cold = warm = 0.0
+    for _ in range(args.rounds):
+        for sec, sec_data in sections:
+            drop_caches(sec_data)
+        start = time.time()
+        size = len(rebuild(hdr, hdr_data, sections))
+        cold += time.time() - start
+
+        start = time.time()
+        rebuild(hdr, hdr_data, sections)
+        warm += time.time() - start
+
+    mb = size * args.rounds / (1024.0 * 1024.0)
+    print("{} bytes, {} rounds".format(size, args.rounds))
+    print("parse:          {:10.2f} MB/s".format(len(raw) * args.rounds / (1024.0 * 1024.0) / decode))
+    print("full rebuild:   {:10.2f} MB/s".format(mb / cold))
+    print("cached rebuild: {:10.2f} MB/s".format(mb / max(warm, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
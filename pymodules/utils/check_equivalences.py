@@ -0,0 +1,172 @@
+"""Checks the equivalences the custom mutator's shortcuts rely on, on a seed."""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import importlib
+import os
+import sys
+
+pymodules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, pymodules_dir)
+sys.path.insert(0, os.path.join(pymodules_dir, '..'))
+
+from wasm.decode import decode_module
+from wasm.validate import ValidationError, validate_module
+
+# a section header cut off in its length
+MALFORMED_SEED = bytearray(b'\0asm\1\0\0\0\x01\x85')
+
+
+def fingerprint(mutators, value):
+    """Returns the decoded fields of `value`, recursively, with their encoded widths."""
+    if isinstance(value, mutators.StructureData):
+        # the fields first, decoding a lazy structure
+        fields = tuple(fingerprint(mutators, getattr(value, field_name)) for field_name, _ in value._meta.fields)
+        return type(value).__name__, tuple(sorted(value._decoder_meta['lengths'].items())), fields
+    if isinstance(value, list):
+        return tuple(fingerprint(mutators, x) for x in value)
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(bytearray(value))
+    return value
+
+
+def check_flat_patch(mutators, raw, rounds, seed):
+    """
+    Applies each byte mutation the mutator patches into the flat seed to
+    the parse tree as well: serializing the tree has to give the same bytes.
+    """
+    mutators.init(seed)
+    mutators.parse_cache.clear()
+    parsed = mutators.parse_seed(raw)
+    out = mutators.PieceTable()
+    out += parsed.hdr
+    parsed.rebuild_into(out)
+    if out.materialize() != raw:
+        return "seed does not rebuild to the same bytes"
+
+    errors = []
+    patch_bytes = mutators.ParsedSeed.patch_bytes
+
+    def patch_both(self, node, value, length=None):
+        patch_bytes(self, node, value, length)
+        if length is not None or errors:
+            # padded LEB128 values differ from a rebuild by design
+            return
+        fix_len = len(value) - len(node.data)
+        node.data[:] = value
+        node.fixup(fix_len, self.journal)
+        out = mutators.PieceTable()
+        out += self.hdr
+        self.rebuild_into(out)
+        if out.materialize() != self.patched.materialize():
+            errors.append("{} of {} patched".format(node.name, node.parent.type))
+
+    mutators.ParsedSeed.patch_bytes = patch_both
+    try:
+        for i in range(rounds):
+            mutators.mutate_seed(parsed)
+            if errors:
+                return "round {}: {}".format(i, errors[0])
+    finally:
+        mutators.ParsedSeed.patch_bytes = patch_bytes
+    return None
+
+
+def check_revert(mutators, raw, rounds, seed):
+    """
+    Mutates the seed's cached parse tree, comparing each section decoded
+    so far with a fresh parse of it after the journal is reverted.
+    """
+    mutators.init(seed)
+    mutators.parse_cache.clear()
+    parsed = mutators.parse_seed(raw)
+    fresh = {}
+    for i in range(rounds):
+        mutators.mutate_seed(parsed)
+        for record in parsed.sections:
+            if record.data is None:
+                continue
+            if record.offs not in fresh:
+                fresh[record.offs] = fingerprint(mutators, mutators.Section().from_raw(None, record.raw)[1])
+            if fingerprint(mutators, record.data) != fresh[record.offs]:
+                return "round {}: section at {} differs".format(i, record.offs)
+    return None
+
+
+def check_trim(mutators, raw, rounds, seed):
+    """
+    Trims the seed, keeping each removal that validates: every candidate,
+    up to `rounds`, has to decode and validate as the seed does.
+    """
+    validate_module(raw)
+    steps = mutators.init_trim(raw)
+    step = 0
+    tried = 0
+    while step < steps and tried < rounds:
+        candidate = mutators.trim()
+        tried += 1
+        try:
+            for _ in decode_module(candidate):
+                pass
+            validate_module(candidate)
+        except ValidationError as e:
+            return "candidate {}: {}".format(tried, e)
+        except Exception as e:
+            return "candidate {}: not decoded, {!r}".format(tried, e)
+        step = mutators.post_trim(True)
+    return None
+
+
+def check_workers(mutators, raw, rounds, seed):
+    """
+    Feeds the worker pool a seed the mutator raises on, then the good one:
+    the former has to raise, the latter to come back from the workers.
+    """
+    mutators.MUTATOR_WORKERS = 2
+    mutators.init(seed)
+    pool = mutators.worker_pool
+    try:
+        try:
+            mutators.fuzz_batch(MALFORMED_SEED, bytearray(), rounds)
+        except Exception:
+            pass
+        else:
+            return "malformed seed did not raise"
+        out = mutators.fuzz_batch(raw, bytearray(), rounds)
+        if len(out) != rounds:
+            return "{} of {} mutants".format(len(out), rounds)
+        if len(pool.rings) != 2:
+            return "{} of 2 workers left".format(len(pool.rings))
+    finally:
+        pool.close()
+        mutators.worker_pool = None
+        mutators.MUTATOR_WORKERS = 0
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('wasm_file', type=str)
+    parser.add_argument('-n', '--rounds', type=int, default=200)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.wasm_file, 'rb') as f:
+        raw = bytearray(f.read())
+
+    mutators = importlib.import_module('pymodules.python-mutators')
+    failed = False
+    for name, check in (
+        ('flat patch == rebuild', check_flat_patch),
+        ('revert == fresh parse', check_revert),
+        ('trim candidates valid', check_trim),
+        ('worker pool recovery', check_workers),
+    ):
+        error = check(mutators, raw, args.rounds, args.seed)
+        print("{:24} {}".format(name + ':', 'FAILED, ' + error if error else 'ok'))
+        failed = failed or error is not None
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
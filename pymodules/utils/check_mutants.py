@@ -0,0 +1,83 @@
+"""Measures the fraction of mutants of a seed that pass validation (see `wasm.validate`)."""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import importlib
+import os
+import random
+import sys
+
+pymodules_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, pymodules_dir)
+sys.path.insert(0, os.path.join(pymodules_dir, '..'))
+
+from wasm.decode import decode_module
+from wasm.modtypes import SEC_CODE
+from wasm.validate import ModuleContext, ValidationError, validate_function, validate_module
+import wasm_insn_op
+
+
+def is_valid(validate, *args):
+    try:
+        validate(*args)
+    except ValidationError:
+        return False
+    return True
+
+
+def check_insertions(raw, rounds, typed):
+    """Inserts instructions into random function bodies, returning the valid fraction."""
+    sections = [x.data for x in decode_module(raw)][1:]
+    context = ModuleContext(sections)
+    bodies = [body for sec in sections if sec.id == SEC_CODE for body in sec.payload.bodies]
+    functions = [context.function(i, body) for i, body in enumerate(bodies)]
+    codes = [bytearray(body.code) for body in bodies]
+
+    valid = 0
+    for _ in range(rounds):
+        i = random.randrange(len(codes))
+        code = bytearray(codes[i])
+        wasm_insn_op.insertInstruction(code, functions[i] if typed else None)
+        valid += is_valid(validate_function, code, functions[i])
+    return valid / rounds
+
+
+def check_fuzz(mutators, raw, rounds, typed):
+    """Runs the custom mutator on the seed, returning the valid fraction of its output."""
+    mutators.TYPED_INSTRUCTIONS = typed
+    mutators.parse_cache.clear()
+    valid = 0
+    for _ in range(rounds):
+        valid += is_valid(validate_module, mutators.fuzz(bytearray(raw), bytearray()))
+    return valid / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('wasm_file', type=str)
+    parser.add_argument('-n', '--rounds', type=int, default=1000)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.wasm_file, 'rb') as f:
+        raw = bytearray(f.read())
+    validate_module(raw)
+
+    mutators = importlib.import_module('pymodules.python-mutators')
+    mutators.init(args.seed)
+    print("{} rounds".format(args.rounds))
+    for typed in (False, True):
+        random.seed(args.seed)
+        print("{:7} insertions: {:6.1%} valid".format(
+            'typed' if typed else 'untyped', check_insertions(raw, args.rounds, typed),
+        ))
+    for typed in (False, True):
+        random.seed(args.seed)
+        print("{:7} mutants:    {:6.1%} valid".format(
+            'typed' if typed else 'untyped', check_fuzz(mutators, raw, args.rounds, typed),
+        ))
+    print("size budget: {shrunk} growths shrunk, {redirected} redirected".format(**mutators.size_budget_counters))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ __version__ = '1.2'
 
 from .decode import (
     decode_bytecode,
+    decode_bytecode_bulk,
     decode_module,
 )
 
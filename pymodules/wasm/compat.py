@@ -71,10 +71,14 @@ if sys.version_info[0] >= 3:
     def byte2int(x):
         return x
 
+    integer_types = (int,)
+
 elif sys.version_info[0] == 2:
     def byte2int(x):
         return ord(x) if type(x) == str else x
 
+    integer_types = (int, long)
+
 else:
     raise Exception("Unsupported Python version")
 
@@ -1,32 +1,173 @@
 """Provides functions for decoding WASM modules and bytecode."""
 from __future__ import print_function, absolute_import, division, unicode_literals
 
+from array import array
 from collections import namedtuple
 from .modtypes import ModuleHeader, Section, SEC_UNK, SEC_NAME, NameSubSection
-from .opcodes import OPCODE_MAP
+from .immtypes import *
+from .opcodes import OPCODE_MAP, OPCODE_TABLE
 from .compat import byte2int
 
 
 Instruction = namedtuple('Instruction', 'op imm len')
+BytecodeArrays = namedtuple('BytecodeArrays', 'op offset len imm0 imm1 end')
 ModuleFragment = namedtuple('ModuleFragment', 'type data')
 
+# Immediate layouts known to `decode_bytecode_bulk`.
+IMM_NONE = 0
+IMM_ULEB = 1        # imm0
+IMM_SLEB = 2        # imm0
+IMM_ULEB_ULEB = 3   # imm0, imm1
+IMM_FIXED32 = 4     # imm0
+IMM_FIXED64 = 5     # imm0, as a signed 64-bit bit pattern
+IMM_BR_TABLE = 6    # imm0 = target_count, imm1 = default_target
 
-def decode_bytecode(bytecode):
-    """Decodes raw bytecode, yielding `Instruction`s."""
-    bytecode_wnd = memoryview(bytecode)
-    while bytecode_wnd:
-        opcode_id = byte2int(bytecode_wnd[0])
+_IMM_LAYOUTS = {
+    BlockImm: IMM_SLEB,
+    BranchImm: IMM_ULEB,
+    BranchTableImm: IMM_BR_TABLE,
+    CallImm: IMM_ULEB,
+    CallIndirectImm: IMM_ULEB_ULEB,
+    LocalVarXsImm: IMM_ULEB,
+    GlobalVarXsImm: IMM_ULEB,
+    MemoryImm: IMM_ULEB_ULEB,
+    CurGrowMemImm: IMM_ULEB,
+    I32ConstImm: IMM_SLEB,
+    I64ConstImm: IMM_SLEB,
+    F32ConstImm: IMM_FIXED32,
+    F64ConstImm: IMM_FIXED64,
+}
+
+# Immediate layout by opcode byte, `None` for unassigned opcodes.
+IMM_LAYOUT_TABLE = [
+    None if x is None else
+    IMM_NONE if x.imm_struct is None else
+    _IMM_LAYOUTS[type(x.imm_struct)]
+    for x in OPCODE_TABLE
+]
+
+
+def decode_bytecode(bytecode, offs=0):
+    """Decodes raw bytecode starting at `offs`, yielding `Instruction`s."""
+    end = len(bytecode)
+    while offs < end:
+        opcode_id = byte2int(bytecode[offs])
         opcode = OPCODE_MAP[opcode_id]
 
         if opcode.imm_struct is not None:
-            offs, imm, _ = opcode.imm_struct.from_raw(None, bytecode_wnd[1:])
+            imm_len, imm, _ = opcode.imm_struct.from_raw(None, bytecode, offs + 1)
         else:
             imm = None
-            offs = 0
+            imm_len = 0
 
-        insn_len = 1 + offs
+        insn_len = 1 + imm_len
         yield Instruction(opcode, imm, insn_len)
-        bytecode_wnd = bytecode_wnd[insn_len:]
+        offs += insn_len
+
+
+def _read_uleb(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _read_sleb(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            if byte & 0x40:
+                value -= 1 << shift
+            return value, pos
+
+
+def _read_fixed(buf, pos, size):
+    if pos + size > len(buf):
+        raise IndexError(pos + size)
+    value = 0
+    for i in range(size):
+        value |= buf[pos + i] << (8 * i)
+    return value, pos + size
+
+
+def decode_bytecode_bulk(bytecode, offs=0):
+    """
+    Decodes raw bytecode starting at `offs` in a single pass, returning a
+    `BytecodeArrays` of parallel arrays: opcode byte, offset into `bytecode`,
+    instruction length and up to two immediates per instruction (see the
+    `IMM_*` layouts; immediates an opcode does not have are 0). Decoding stops
+    at an unassigned opcode or a truncated immediate, `end` is the offset it
+    stopped at and equals `len(bytecode)` if all of it decoded.
+    """
+    # a bytearray indexes to ints on Py2, too
+    buf = bytearray(bytecode)
+    end = len(buf)
+    ops = array('B')
+    offsets = array('L')
+    lengths = array('L')
+    imm0 = []
+    imm1 = []
+    layouts = IMM_LAYOUT_TABLE
+
+    pos = offs
+    while pos < end:
+        start = pos
+        op = buf[pos]
+        layout = layouts[op]
+        if layout is None:
+            break
+        pos += 1
+        a = b = 0
+        try:
+            if layout == IMM_ULEB:
+                a = buf[pos]
+                if a < 0x80:
+                    pos += 1
+                else:
+                    a, pos = _read_uleb(buf, pos)
+            elif layout == IMM_SLEB:
+                a, pos = _read_sleb(buf, pos)
+            elif layout == IMM_ULEB_ULEB:
+                a, pos = _read_uleb(buf, pos)
+                b, pos = _read_uleb(buf, pos)
+            elif layout == IMM_FIXED32:
+                a, pos = _read_fixed(buf, pos, 4)
+            elif layout == IMM_FIXED64:
+                a, pos = _read_fixed(buf, pos, 8)
+                if a >= 1 << 63:
+                    a -= 1 << 64
+            elif layout == IMM_BR_TABLE:
+                a, pos = _read_uleb(buf, pos)
+                for _ in range(a):
+                    _, pos = _read_uleb(buf, pos)
+                b, pos = _read_uleb(buf, pos)
+        except IndexError:
+            pos = start
+            break
+
+        ops.append(op)
+        offsets.append(start)
+        lengths.append(pos - start)
+        imm0.append(a)
+        imm1.append(b)
+
+    # like `decode_leb128_run`, values beyond a machine word stay in lists
+    try:
+        imm0 = array('l', imm0)
+        imm1 = array('l', imm1)
+    except OverflowError:
+        pass
+    return BytecodeArrays(ops, offsets, lengths, imm0, imm1, pos)
 
 
 def decode_module(module, decode_name_subsections=False):
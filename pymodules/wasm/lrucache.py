@@ -0,0 +1,43 @@
+"""Defines a least recently used cache bounded by the footprint of its entries."""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import collections
+
+
+class LRUCache(object):
+    """
+    Values by key, made on demand, evicting the least recently used ones
+    once the estimated footprint of all entries exceeds `max_bytes`. The
+    footprint of an entry is `cost(key, value)`, taken when it is made.
+    """
+    def __init__(self, max_bytes, cost):
+        self.max_bytes = max_bytes
+        self.cost = cost
+        # key -> (value, cost), least recently used first
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, create):
+        """Returns the value of `key`, made by `create(key)` if not cached."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            value = create(key)
+            entry = (value, self.cost(key, value))
+            self.bytes += entry[1]
+        self.entries[key] = entry
+
+        # evict least recently used entries, but always keep the current one
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, cost) = self.entries.popitem(last=False)
+            self.bytes -= cost
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
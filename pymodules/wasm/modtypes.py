@@ -107,21 +107,24 @@ class MemorySection(Structure):
         setattr(value,'count',len(getattr(value,'entries')))
 
 class InitExpr(WasmField):
-    def from_raw(self, struct, raw):
+    def from_raw(self, struct, raw, offs=0):
         from .decode import decode_bytecode
 
-        offs = 0
+        length = 0
         instrs = []
-        for cur_insn in decode_bytecode(raw):
-            offs += cur_insn.len
+        for cur_insn in decode_bytecode(raw, offs):
+            length += cur_insn.len
             instrs.append(cur_insn)
             if cur_insn.op.id == OP_END:
                 break
-        return offs, raw[:offs], self
+        return length, raw[offs:offs + length], self
         #return offs, instrs, self
     def rebuild(self,value):
         return value  #.tobytes()
 
+    def rebuild_into(self, value, out):
+        out += value
+
 class GlobalEntry(Structure):
     type = GlobalType()
     init = InitExpr()
@@ -192,6 +195,13 @@ class FunctionBody(Structure):
             x.get_decoder_meta()['lengths']['locals']
         )
     )
+    def from_raw(self, ctx, raw, offs=0):
+        # Function bodies are only decoded once a mutation or dump gets to
+        # them, parsing a code section just skips from body to body.
+        size_len, body_size, _ = self.body_size.from_raw(None, raw, offs)
+        length = size_len + body_size
+        return length, self.lazy_data(raw, offs, length), self
+
     def fix(self,value):
         setattr(value,'local_count',len(getattr(value,'locals')))
         _body_size = value.get_decoder_meta()['lengths']['local_count'] + value.get_decoder_meta()['lengths']['locals']+ value.get_decoder_meta()['lengths']['code']
@@ -307,5 +317,5 @@ class Section(Structure):
     def fix(self,value):
         _payload_len = value.get_decoder_meta()['lengths']['name'] + value.get_decoder_meta()['lengths']['name_len'] + value.get_decoder_meta()['lengths']['payload']
         setattr(value,'payload_len',_payload_len)  
-        if getattr(value,'id') == 0:
+        if getattr(value,'id') == 0 and getattr(value,'name') is not None:
              setattr(value,'name_len',len(getattr(value,'name')))  
@@ -200,6 +200,9 @@ OPCODES = [
 
 OPCODE_MAP = {x.id: x for x in OPCODES}
 
+# `OPCODE_MAP` as a list indexed by opcode byte, `None` for unassigned ones.
+OPCODE_TABLE = [OPCODE_MAP.get(x) for x in range(256)]
+
 # Generate integer constants for opcodes.
 for cur_op in OPCODES:
     globals()[
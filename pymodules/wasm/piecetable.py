@@ -0,0 +1,66 @@
+"""Defines a piece table for assembling serialized modules."""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+
+class PieceTable(object):
+    """
+    Output buffer recording a list of `(source, start, length)` pieces instead
+    of copying every appended buffer. Immutable sources (`bytes`, read-only
+    memoryviews like the views into a parsed seed) are referenced, all other
+    data is copied into small fresh buffers. `materialize` assembles the
+    pieces in a single preallocated copy.
+
+    Appending to a table costs a Python call, so it is meant for a few large
+    pieces; structures are still serialized into plain bytearrays.
+    """
+    # sources shorter than this are copied rather than referenced
+    min_piece_len = 64
+
+    def __init__(self):
+        self.pieces = []
+        self.fresh = bytearray()
+        self.length = 0
+
+    def __len__(self):
+        return self.length + len(self.fresh)
+
+    def _flush(self):
+        if self.fresh:
+            self.pieces.append((self.fresh, 0, len(self.fresh)))
+            self.length += len(self.fresh)
+            self.fresh = bytearray()
+
+    def add(self, source, start=0, length=None, stable=False):
+        """
+        Appends `length` bytes of `source` from `start` on. Pass `stable` for
+        a mutable source that is left alone until the table is materialized.
+        """
+        if length is None:
+            length = len(source) - start
+        if length < self.min_piece_len or not (
+            stable or
+            isinstance(source, bytes) or
+            isinstance(source, memoryview) and source.readonly
+        ):
+            self.fresh += source[start:start + length]
+            return
+        self._flush()
+        self.pieces.append((source, start, length))
+        self.length += length
+
+    def __iadd__(self, source):
+        self.add(source)
+        return self
+
+    def append(self, byte):
+        self.fresh.append(byte)
+
+    def materialize(self):
+        """Assembles the pieces into a new `bytearray`."""
+        self._flush()
+        out = bytearray(self.length)
+        pos = 0
+        for source, offs, length in self.pieces:
+            out[pos:pos + length] = source[offs:offs + length]
+            pos += length
+        return out
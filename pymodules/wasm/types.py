@@ -1,45 +1,213 @@
 """Defines a simple, generic data (de)serialization mechanism."""
 from __future__ import print_function, absolute_import, division, unicode_literals
 
-from .compat import add_metaclass, byte2int, indent, deprecated_func
+from .compat import add_metaclass, byte2int, indent, deprecated_func, integer_types
 import collections
 import logging
+import sys
+from array import array
 import struct as pystruct
 import copy
 import traceback
 
 logger = logging.getLogger()
 
+class Journal(object):
+    """
+    Undo log for parse tree mutations. Objects are recorded right before they
+    are changed for the first time, `revert` rolls the tree back to the state
+    it had when recording started.
+    """
+    def __init__(self):
+        self.entries = []
+        self.seen = set()
+
+    def _first(self, obj, key):
+        key = (id(obj), key)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
+
+    def record_attr(self, obj, name):
+        """Records the value of attribute `name` of `obj`."""
+        if self._first(obj, name):
+            self.entries.append((obj, name, getattr(obj, name)))
+
+    def record_fields(self, data):
+        """Records all field values of a `StructureData`."""
+        for cur_field_name, cur_field in data._meta.fields:
+            self.record_attr(data, cur_field_name)
+
+    def record_lengths(self, data):
+        """Records the decoder lengths of a `StructureData`."""
+        if self._first(data, '_decoder_meta'):
+            self.entries.append((data, None, dict(data._decoder_meta['lengths'])))
+
+    def record_buffer(self, buf):
+        """Records the contents of a list, bytearray or array mutated in place."""
+        if self._first(buf, None):
+            self.entries.append((buf, Ellipsis, buf[:]))
+
+    def revert(self):
+        """Undoes all recorded changes and clears the journal."""
+        for obj, name, value in reversed(self.entries):
+            if name is None:
+                obj._decoder_meta['lengths'] = value
+            elif name is Ellipsis:
+                obj[:] = value
+            else:
+                setattr(obj, name, value)
+        del self.entries[:]
+        self.seen.clear()
+
+
 #'name':cur_field_name,'type':field_type,'data':field_val,'parent':pnode
 class Node(object):
-    def __init__(self,_name,_type,_data,_parent):
+    # parse trees hold one node per field, keep them small
+    __slots__ = ('name', 'type', 'data', 'parent', 'index', 'depth', 'section')
+
+    def __init__(self,_name,_type,_data,_parent,_index=None):
         self.name = _name
         self.type = _type
         self.data = _data
         self.parent = _parent
+        # position in the parent's list, if the parent is a RepeatField
+        self.index = _index
+        if _parent is None:
+            self.depth = 0
+            # for the root of a section, its payload type, e.g. 'CodeSection'
+            payload_type = None
+            if isinstance(_data, StructureData):
+                payload_type = _data._decoder_meta['types'].get('payload')
+            self.section = type(payload_type or _data).__name__
+        else:
+            self.depth = _parent.depth + 1
+            self.section = _parent.section
+
+    def save(self, journal):
+        """Records everything a mutator can change directly on this node."""
+        journal.record_attr(self, 'data')
+        if isinstance(self.data, (list, bytearray, array)):
+            journal.record_buffer(self.data)
+        parent = self.parent
+        if parent is not None and isinstance(parent.data, StructureData):
+            journal.record_attr(parent.data, self.name)
+
+    def make_writable(self):
+        """
+        Replaces a read-only view into the input buffer by a private copy,
+        written through to the parent structure (copy-on-write).
+        """
+        if not isinstance(self.data, memoryview):
+            return
+        self.data = bytearray(self.data)
+        parent = self.parent
+        if parent is not None and isinstance(parent.data, StructureData):
+            setattr(parent.data, self.name, self.data)
+
+    def set_data(self, value):
+        """
+        Replaces the value of a leaf node, writing it through to the parent
+        structure. Returns the change of the field's encoded length.
+        """
+        self.data = value
+        parent = self.parent
+        if parent is None or not isinstance(parent.data, StructureData):
+            return 0
+        setattr(parent.data, self.name, value)
+        return len(self.type.rebuild(value)) - parent.data._decoder_meta['lengths'][self.name]
         
-    def fix_node_data_length(self,fix_length):
-        node = self
-        while True:
-            cur_field_name = node.name
-            parent_node = node.parent
-            if parent_node == None:     # no need fix,fix all fields
-                break
-            if type(parent_node.data) == list: #not data object pass
-                pass
-            else:
-                parent_node.data._decoder_meta['lengths'][cur_field_name] += fix_length
-            node = node.parent
+    def fixup(self, fix_length=0, journal=None):
+        """
+        Fixes the tree after the value of this node was changed, `fix_length`
+        being the change of its encoded length. See `fixup_nodes`.
+        """
+        fixup_nodes([(self, fix_length)], journal)
 
-    def fix(self):
-        node = self
-        while True:
-            if node == None:
-                break
+    def field_name(self):
+        """Obtains the name of the parent structure's field holding this node."""
+        if isinstance(self.data, StructureData):
+            # nested structures are named after their type's last use
+            for cur_field_name, cur_field in self.parent.data._meta.fields:
+                if getattr(self.parent.data, cur_field_name) is self.data:
+                    return cur_field_name
+        return self.name
+
+
+def fixup_nodes(changes, journal=None):
+    """
+    Fixes a parse tree after mutations, given as `(node, fix_length)` pairs of
+    the changed nodes and the change of their encoded length. In one upward
+    sweep, deepest level first, the recorded lengths of every structure on
+    the way to the root are updated, its `fix` resets counts and length
+    fields, and changes of the encoded width of those are passed on to its
+    parent. Each structure is fixed once, however many changes lie below it.
+
+    The length of a changed scalar or byte field is measured, `fix_length`
+    only matters for structures and lists of structures.
+    """
+    levels = {}
+    for node, fix_length in changes:
+        parent = node.parent
+        if (
+            parent is not None and isinstance(parent.data, StructureData) and
+            isinstance(node.type, _MEASURED_FIELD_TYPES) and
+            not (node.data and isinstance(node.data, list) and isinstance(node.data[0], StructureData))
+        ):
+            lengths = parent.data._decoder_meta['lengths']
+            fix_length = len(node.type.rebuild(node.data)) - lengths[node.name]
+        level = levels.setdefault(node.depth, {})
+        level[node] = level.get(node, 0) + fix_length
+
+    depth = max(levels) if levels else -1
+    while depth >= 0:
+        for node, fix_length in levels.pop(depth, {}).items():
             if isinstance(node.data, StructureData):
-                node.data._meta.structure().fix(node.data)
-            node = node.parent
-        
+                fix_length += _fix_structure(node.data, journal)
+            parent = node.parent
+            if parent is None:
+                continue
+            if isinstance(parent.data, StructureData) and fix_length:
+                if journal is not None:
+                    journal.record_lengths(parent.data)
+                parent.data._decoder_meta['lengths'][node.field_name()] += fix_length
+            level = levels.setdefault(depth - 1, {})
+            level[parent] = level.get(parent, 0) + fix_length
+        depth -= 1
+
+
+def _fix_structure(data, journal):
+    """
+    Runs the `fix` method of a structure until the encoded widths of the
+    fields it sets are stable, returning the change of the structure's length.
+    """
+    if journal is not None:
+        journal.record_fields(data)
+        journal.record_attr(data, '_dirty')
+        journal.record_lengths(data)
+    data._dirty = True
+    meta = data._meta
+    lengths = data._decoder_meta['lengths']
+    types = data._decoder_meta['types']
+    fix_length = 0
+    for _ in range(len(meta.fields) + 1):
+        before = [getattr(data, cur_field_name) for cur_field_name, cur_field in meta.fields]
+        meta.get_structure().fix(data)
+        resized = False
+        for (cur_field_name, cur_field), value in zip(meta.fields, before):
+            new_value = getattr(data, cur_field_name)
+            if isinstance(new_value, integer_types) and new_value != value:
+                delta = len(types[cur_field_name].rebuild(new_value)) - lengths[cur_field_name]
+                if delta:
+                    lengths[cur_field_name] += delta
+                    fix_length += delta
+                    resized = True
+        if not resized:
+            break
+    return fix_length
+
+
 class WasmField(object):
     """
     Abstract base class for all fields.
@@ -60,7 +228,12 @@ class WasmField(object):
         self._type_id = WasmField._type_ctr
         WasmField._type_ctr += 1
    
-    def from_raw(self, struct, raw):
+    def from_raw(self, struct, raw, offs=0):
+        """
+        Decodes a value starting at `raw[offs]`, returning a tuple of the
+        number of bytes consumed, the value and the field type it was decoded
+        with.
+        """
         raise NotImplementedError()
 
     def to_string(self, value):
@@ -68,6 +241,10 @@ class WasmField(object):
     
     def rebuild(self,value):
         raise NotImplementedError()
+
+    def rebuild_into(self, value, out):
+        """Serializes `value`, appending the bytes to the bytearray `out`."""
+        out += self.rebuild(value)
     
     def fix(self,data):
         pass
@@ -87,8 +264,8 @@ class UIntNField(WasmField):
         self.byte_size = n // 8
         self.converter = self.CONVERTER_MAP[n]
 
-    def from_raw(self, ctx, raw):
-        return self.byte_size, self.converter.unpack(raw[:self.byte_size])[0], self
+    def from_raw(self, ctx, raw, offs=0):
+        return self.byte_size, self.converter.unpack(raw[offs:offs + self.byte_size])[0], self
 
     def to_string(self, value):
         return hex(byte2int(value) if self.n == 8 else value)
@@ -96,57 +273,53 @@ class UIntNField(WasmField):
     def rebuild(self,value):
         return self.converter.pack(value)
 
+    def rebuild_into(self, value, out):
+        out += self.converter.pack(value)
+
 
 class UnsignedLeb128Field(WasmField):
     """
     Field handling unsigned LEB128 values.
     https://en.wikipedia.org/wiki/LEB128
     """
-    def from_raw(self, ctx, raw):
-        offs = 0
+    def from_raw(self, ctx, raw, offs=0):
+        length = 0
         val = 0
 
         while True:
-            segment = byte2int(raw[offs])
-            val |= (segment & 0x7F) << (offs * 7)
-            offs += 1
+            segment = byte2int(raw[offs + length])
+            val |= (segment & 0x7F) << (length * 7)
+            length += 1
             if not (segment & 0x80):
                 break
 
-        return offs, val, self
+        return length, val, self
 
     def to_string(self, value):
         return hex(value) if value > 1000 else str(value)
     
     def rebuild(self,value):
-        #print(value)   
-        bytes = b""
-        while True:
-            if value < 0:      
-                value = -value
-            byte = value &0x7f
-            value >>= 7
-            if value !=0:
-                byte |=0x80
-            bytes+= pystruct.Struct('<B').pack(byte)
-            if value ==0:
-                break
-        return bytes
+        out = bytearray()
+        write_unsigned_leb128(out, value)
+        return bytes(out)
+
+    def rebuild_into(self, value, out):
+        write_unsigned_leb128(out, value)
 
 class SignedLeb128Field(WasmField):
     """
     Field handling signed LEB128 values.
     https://en.wikipedia.org/wiki/LEB128
     """
-    def from_raw(self, ctx, raw):
-        offs = 0
+    def from_raw(self, ctx, raw, offs=0):
+        length = 0
         val = 0
         bits = 0
 
         while True:
-            segment = byte2int(raw[offs])
+            segment = byte2int(raw[offs + length])
             val |= (segment & 0x7F) << bits
-            offs += 1
+            length += 1
             bits += 7
             if not (segment & 0x80):
                 break
@@ -154,22 +327,106 @@ class SignedLeb128Field(WasmField):
         if val & (1 << (bits - 1)):
             val -= 1 << bits
 
-        return offs, val, self
+        return length, val, self
     
     def rebuild(self,value):
-        bytes = b''
-        more = True
-        while more:
-            byte = value & 0x7f
-            value >>= 7
-            if (value == 0 and (byte & 0x40) == 0) or (value == -1 and (byte & 0x40) != 0):
-                more = False
-            else:
-                byte |= 0x80
-            bytes+= pystruct.Struct('<B').pack(byte)
-        return bytes
-    
-  
+        out = bytearray()
+        write_signed_leb128(out, value)
+        return bytes(out)
+
+    def rebuild_into(self, value, out):
+        write_signed_leb128(out, value)
+
+
+def decode_leb128_run(raw, offs, count, signed=False):
+    """
+    Decodes `count` consecutive LEB128 values from `raw[offs]` on in a single
+    loop, returning the consumed length and the values as an `array`. Values
+    not representable by a machine word are returned in a list instead.
+    """
+    # a bytearray indexes to ints on Py2, too; 10 bytes hold any 64-bit value
+    buf = bytearray(raw[offs:offs + 10 * count])
+    try:
+        pos, values = _decode_leb128_run(buf, count, signed)
+    except IndexError:
+        if len(buf) < 10 * count:
+            raise
+        # overlong encodings
+        pos, values = _decode_leb128_run(bytearray(raw[offs:]), count, signed)
+    try:
+        return pos, array('l' if signed else 'L', values)
+    except OverflowError:
+        return pos, values
+
+
+def _decode_leb128_run(buf, count, signed):
+    values = []
+    append = values.append
+    pos = 0
+    for _ in range(count):
+        byte = buf[pos]
+        pos += 1
+        if byte < 0x80:
+            value = byte
+            shift = 7
+        else:
+            value = byte & 0x7f
+            shift = 7
+            while byte & 0x80:
+                byte = buf[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+        if signed and byte & 0x40:
+            value -= 1 << shift
+        append(value)
+    return pos, values
+
+
+def write_unsigned_leb128(out, value):
+    """Appends the unsigned LEB128 encoding of `value` to the bytearray `out`."""
+    if value < 0:
+        value = -value
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def write_signed_leb128(out, value):
+    """Appends the signed LEB128 encoding of `value` to the bytearray `out`."""
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+            out.append(byte)
+            return
+        out.append(byte | 0x80)
+
+
+def encode_padded_leb128(value, width, signed=False):
+    """
+    Encodes `value` as LEB128 of exactly `width` bytes, padding it with
+    redundant continuation bytes. Returns `None` if it does not fit.
+    """
+    bits = 7 * width
+    if signed:
+        if not -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+            return None
+        value &= (1 << bits) - 1
+    else:
+        # like `write_unsigned_leb128`
+        if value < 0:
+            value = -value
+        if value >= 1 << bits:
+            return None
+    out = bytearray()
+    for i in range(width - 1):
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
 
 class CondField(WasmField):
     """Optionalizes a field, depending on the context."""
@@ -178,10 +435,10 @@ class CondField(WasmField):
         self.field = field
         self.condition = condition
 
-    def from_raw(self, ctx, raw):
+    def from_raw(self, ctx, raw, offs=0):
         #print(ctx._meta.fields)
         if self.condition(ctx):
-            return self.field.from_raw(ctx, raw)
+            return self.field.from_raw(ctx, raw, offs)
         return 0, None, self
 
     def to_string(self, value):
@@ -193,6 +450,10 @@ class CondField(WasmField):
             return b''
         else:
             raise NotImplementedError("todo")
+
+    def rebuild_into(self, value, out):
+        if value is not None:
+            raise NotImplementedError("todo")
         
 
 class RepeatField(WasmField):
@@ -202,22 +463,31 @@ class RepeatField(WasmField):
         self.field = field
         self.repeat_count_getter = repeat_count_getter
 
-    def from_raw(self, ctx, raw):
+    def from_raw(self, ctx, raw, offs=0):
         repeat_count = self.repeat_count_getter(ctx)
 
         # Avoiding complex processing for byte arrays.
         if type(self.field) == UIntNField and self.field.n == 8:
-            return repeat_count, raw[:repeat_count], self
+            return repeat_count, raw[offs:offs + repeat_count], self
+
+        # Runs of LEB128 integers are decoded in bulk.
+        if type(self.field) == UnsignedLeb128Field:
+            length, values = decode_leb128_run(raw, offs, repeat_count)
+            return length, values, self
+        if type(self.field) == SignedLeb128Field:
+            length, values = decode_leb128_run(raw, offs, repeat_count, signed=True)
+            return length, values, self
 
         # For more complex types, invoke the field for parsing the
         # individual fields.
-        offs = 0
+        start = offs
         items = []
+        field_from_raw = self.field.from_raw
         for i in range(repeat_count):
-            length, item, element_type = self.field.from_raw(ctx, raw[offs:])
+            length, item, element_type = field_from_raw(ctx, raw, offs)
             offs += length
             items.append(item)
-        return offs, items, self
+        return offs - start, items, self
 
     def to_string(self, value):
         if value is None:
@@ -235,38 +505,50 @@ class RepeatField(WasmField):
             return '[' + ', '.join(self.field.to_string(x) for x in value) + ']'
         
     def rebuild(self,value):
-        buf = b''
         if type(self.field) == UIntNField and self.field.n == 8:
             return value#.tobytes()
-        if value is None:
-            return b''
-        if len(value) == 0:
-            return b''
+        out = bytearray()
+        self.rebuild_into(value, out)
+        return out
+
+    def rebuild_into(self, value, out):
+        if type(self.field) == UIntNField and self.field.n == 8:
+            out += value
+            return
+        if not value:
+            return
+        field_rebuild_into = self.field.rebuild_into
         for x in value:
-            buf += self.field.rebuild(x)
-        return buf
+            field_rebuild_into(x, out)
     
-    def get_all_nodes(self,value,parent=None):
+    def get_all_nodes(self,value,parent=None,lazy=None):
         nodes = []
         if value is None:
             return None
         if len(value) == 0:
             return None
-        for x in value:
-            if isinstance(x, StructureData) or isinstance(x, RepeatField):
-                nodes += x.get_all_nodes(parent)
+        for i, x in enumerate(value):
+            if lazy is not None and isinstance(x, StructureData) and x._lazy is not None:
+                # not decoded yet, left to the caller: (data, parent, index)
+                lazy.append((x, parent, i))
+            elif isinstance(x, StructureData) or isinstance(x, RepeatField):
+                nodes += x.get_all_nodes(parent, i, lazy)
             else:
                 return None
         return nodes
     
     
+# leaf fields whose encoded length `fixup_nodes` measures
+_MEASURED_FIELD_TYPES = (UIntNField, UnsignedLeb128Field, SignedLeb128Field, RepeatField)
+
+
 class ConstField(WasmField):
     """Pseudo-Field, always returning a constant, consuming/generating no data."""
     def __init__(self, const, **kwargs):
         super(ConstField, self).__init__(**kwargs)
         self.const = const
 
-    def from_raw(self, ctx, raw):
+    def from_raw(self, ctx, raw, offs=0):
         return 0, self.const, self
 
 
@@ -280,11 +562,11 @@ class ChoiceField(WasmField):
         self.choice_getter = choice_getter
         self.choice_data = None
 
-    def from_raw(self, ctx, raw):
+    def from_raw(self, ctx, raw, offs=0):
         choice = self.choice_getter(ctx)
         if choice is None:
             return 0, None, self._shared_none_field
-        length, obj_data, obj_type  = self.choice_field_map[choice].from_raw(ctx, raw)
+        length, obj_data, obj_type  = self.choice_field_map[choice].from_raw(ctx, raw, offs)
         self.choice_data = obj_data
         return length, obj_data, obj_type 
 
@@ -313,11 +595,20 @@ class MetaInfo(object):
         self.data_class = None
         self.structure = None
         self.name = ''
+        # generated decoder of all fields, see `StructureData.__getattr__`
+        self.decode = None
+        self._instance = None
+
+    def get_structure(self):
+        """Obtains a shared instance of the structure, e.g. to call `fix` on."""
+        if self._instance is None:
+            self._instance = self.structure()
+        return self._instance
      
 
 class StructureData(object):
     """Base class for generated structure data classes."""
-    __slots__ = ('_meta', '_decoder_meta','_data_id')
+    __slots__ = ('_meta', '_decoder_meta','_data_id', '_cache', '_dirty', '_lazy')
     #_data_instance = 0
     def __init__(self, for_decoding=False):
         #self._data_id = StructureData._data_instance
@@ -325,9 +616,28 @@ class StructureData(object):
 
 
         self._decoder_meta = {'lengths': {}, 'types': {}} if for_decoding else None
+        # serialized bytes of the unmodified structure, see `Structure.rebuild`
+        self._cache = None
+        self._dirty = False
+        # (structure, raw, offs) while the fields are not decoded yet
+        self._lazy = None
         for cur_field_name, cur_field in self._meta.fields:
             setattr(self, cur_field_name, None)
 
+    def __getattr__(self, name):
+        # Only reached for unset slots, i.e. the fields of a structure created
+        # by `Structure.lazy_data`: decode them now.
+        if name != '_lazy' and self._lazy is not None:
+            structure, raw, offs = self._lazy
+            self._lazy = None
+            _, full, _ = self._meta.decode(structure, None, raw, offs)
+            for cur_field_name, cur_field in self._meta.fields:
+                setattr(self, cur_field_name, getattr(full, cur_field_name))
+            self._decoder_meta['lengths'].update(full._decoder_meta['lengths'])
+            self._decoder_meta['types'].update(full._decoder_meta['types'])
+            return getattr(self, name)
+        raise AttributeError(name)
+
     def get_meta(self):
         """
         Obtains meta info for this object. The object returned is shared
@@ -344,13 +654,36 @@ class StructureData(object):
         For objects not created through decoding, `None` is returned.
         """
         return self._decoder_meta
-    def get_all_nodes(self,parent=None):
-        
+
+    def get_raw_length(self):
+        """
+        Obtains the byte length of a decoded structure in raw format. Only
+        meaningful as long as the structure is not modified.
+        """
+        if self._lazy is not None:
+            return len(self._cache)
+        return sum(self._decoder_meta['lengths'].values())
+
+    def get_raw_field_offset(self, field_name):
+        """Obtains the offset of a field from the start of the decoded structure."""
+        offs = 0
+        lengths = self._decoder_meta['lengths']
+        for cur_field_name, cur_field in self._meta.fields:
+            if cur_field_name == field_name:
+                return offs
+            offs += lengths[cur_field_name]
+        raise KeyError(field_name)
+
+    def get_all_nodes(self,parent=None,index=None,lazy=None):
+        """
+        Lists the nodes of this structure. With a list `lazy`, repeated
+        structures not decoded yet are skipped and appended to it instead.
+        """
         nodes = []
         node_name = self._meta.name#self._meta.structure.__name__#+str(self._data_id) diff cond and class name
         node_type = self._meta.structure
         #pnode = {'name':node_name,'type':node_type,'data':self,'parent':parent}
-        pnode = Node(node_name,node_type,self,parent)
+        pnode = Node(node_name,node_type,self,parent,index)
         nodes.append(pnode)
         #print({'name':node_name,'data':self,'parent':parent})
         for cur_field_name, cur_field in self._meta.fields:
@@ -358,11 +691,11 @@ class StructureData(object):
             field_type = self.get_decoder_meta()['types'][cur_field_name]
             #print('[!]',cur_field_name,field_type)
             if isinstance(field_val, StructureData):
-                nodes += field_val.get_all_nodes(pnode)
+                nodes += field_val.get_all_nodes(pnode, lazy=lazy)
             elif isinstance(field_type, RepeatField):
                 cnode = Node(cur_field_name,field_type,field_val,pnode)
                 nodes.append(cnode)
-                _node = field_type.get_all_nodes(field_val,cnode)
+                _node = field_type.get_all_nodes(field_val,cnode,lazy)
                 if _node != None:
                     nodes += _node
             else:
@@ -373,7 +706,32 @@ class StructureData(object):
         return nodes
     def rebuild(self):
     #    print(self)
-        return self._meta.structure().rebuild(self)
+        return self._meta.get_structure().rebuild(self)
+
+    def clone(self, memo=None):
+        """
+        Creates a mutable copy of this (decoded) structure. Nested structures,
+        lists and byte buffers are duplicated, field types and other immutable
+        values are shared. If `memo` is passed, it is filled with a mapping of
+        `id(original)` to its copy for every duplicated object.
+        """
+        if memo is None:
+            memo = {}
+        dup = self.__class__.__new__(self.__class__)
+        memo[id(self)] = dup
+        decoder_meta = self._decoder_meta
+        if decoder_meta is not None:
+            decoder_meta = {
+                'lengths': dict(decoder_meta['lengths']),
+                'types': decoder_meta['types'],
+            }
+        dup._decoder_meta = decoder_meta
+        dup._cache = None if self._dirty else self._cache
+        dup._dirty = False
+        dup._lazy = None
+        for cur_field_name, cur_field in self._meta.fields:
+            setattr(dup, cur_field_name, _clone_value(getattr(self, cur_field_name), memo))
+        return dup
 
     @property
     @deprecated_func
@@ -382,6 +740,107 @@ class StructureData(object):
         return self._decoder_meta
 
 
+def _clone_value(value, memo):
+    """Copies a single field value for `StructureData.clone`."""
+    if isinstance(value, StructureData):
+        return value.clone(memo)
+    if isinstance(value, list):
+        dup = [_clone_value(x, memo) for x in value]
+    elif isinstance(value, bytearray):
+        dup = bytearray(value)
+    elif isinstance(value, array):
+        dup = value[:]
+    else:
+        return value
+    memo[id(value)] = dup
+    return dup
+
+
+# Generated decoders index raw buffers directly where that yields ints (Py3).
+_RAW_BYTE = 'raw[{}]' if sys.version_info[0] >= 3 else 'byte2int(raw[{}])'
+
+
+def _generate_codecs(name, meta):
+    """
+    Generates `from_raw` and `rebuild_into` for the fields of a structure.
+    The field loop of the generic `Structure` implementation is unrolled,
+    offsets are threaded through instead of slicing the input, and LEB128
+    fields are decoded inline.
+    """
+    env = {
+        'data_class': meta.data_class,
+        'StructureData': StructureData,
+        'byte2int': byte2int,
+        'write_unsigned_leb128': write_unsigned_leb128,
+        'write_signed_leb128': write_signed_leb128,
+    }
+    dec = [
+        'def from_raw(self, ctx, raw, offs=0):',
+        '    start = offs',
+        '    data = data_class.__new__(data_class)',
+        '    lengths = {}',
+        '    types = {}',
+        "    data._decoder_meta = {'lengths': lengths, 'types': types}",
+        '    data._cache = None',
+        '    data._dirty = False',
+        '    data._lazy = None',
+    ]
+    enc = [
+        'def rebuild_into(self, value, out):',
+        '    dirty = value._dirty',
+        '    if not dirty and value._cache is not None:',
+        '        out += value._cache',
+        '        return',
+        '    start = len(out)',
+        "    types = value._decoder_meta['types']",
+    ]
+    for i, (cur_field_name, cur_field) in enumerate(meta.fields):
+        field_ref = 'f{}'.format(i)
+        env[field_ref] = cur_field
+        signed = type(cur_field) is SignedLeb128Field
+        if signed or type(cur_field) is UnsignedLeb128Field:
+            dec += [
+                '    b = ' + _RAW_BYTE.format('offs'),
+                '    v = b & 0x7f',
+                '    n = 1',
+                '    while b & 0x80:',
+                '        b = ' + _RAW_BYTE.format('offs + n'),
+                '        v |= (b & 0x7f) << (7 * n)',
+                '        n += 1',
+            ]
+            if signed:
+                dec += [
+                    '    if v & (1 << (7 * n - 1)):',
+                    '        v -= 1 << (7 * n)',
+                ]
+            dec.append('    t = ' + field_ref)
+            enc.append('    write_{}_leb128(out, value.{})'.format(
+                'signed' if signed else 'unsigned', cur_field_name
+            ))
+        else:
+            dec.append('    n, v, t = {}.from_raw(data, raw, offs)'.format(field_ref))
+            if not isinstance(cur_field, (UIntNField, RepeatField)):
+                dec += [
+                    '    if isinstance(v, StructureData):',
+                    '        v._meta.name = {!r}'.format(cur_field_name),
+                ]
+            enc.append('    types[{0!r}].rebuild_into(value.{0}, out)'.format(cur_field_name))
+        dec += [
+            '    data.{} = v'.format(cur_field_name),
+            '    lengths[{!r}] = n'.format(cur_field_name),
+            '    types[{!r}] = t'.format(cur_field_name),
+            '    offs += n',
+        ]
+    dec.append('    return offs - start, data, self')
+    enc += [
+        '    if not dirty:',
+        '        value._cache = memoryview(out)[start:].tobytes()',
+    ]
+    source = '\n'.join(dec) + '\n\n' + '\n'.join(enc) + '\n'
+    exec(compile(source, '<generated codecs of {}>'.format(name), 'exec'), env)
+    return env
+
+
 class StructureMeta(type):
     """
     Metaclass used to create `Structure` classes,
@@ -422,6 +881,12 @@ class StructureMeta(type):
             _meta = meta
         meta.data_class = GeneratedStructureData
 
+        # Specialize the decoder and encoder, unless defined explicitly.
+        codecs = _generate_codecs(name, meta)
+        meta.decode = codecs['from_raw']
+        cls_dict.setdefault('from_raw', codecs['from_raw'])
+        cls_dict.setdefault('rebuild_into', codecs['rebuild_into'])
+
         # Create class, saving type ref in meta.
         meta.structure = type.__new__(mcs, name, bases, cls_dict)
         return meta.structure
@@ -430,13 +895,13 @@ class StructureMeta(type):
 @add_metaclass(StructureMeta)
 class Structure(WasmField):
     """Represents a collection of named fields."""
-    def from_raw(self, ctx, raw):
-        offs = 0
+    def from_raw(self, ctx, raw, offs=0):
+        start = offs
         data = self._meta.data_class(for_decoding=True)
         #print(data._meta.structure.__name__+str(data._data_id), data) #data msg
         #print("**************************")
         for cur_field_name, cur_field in self._meta.fields:
-            data_len, val, data_type = cur_field.from_raw(data, raw[offs:])#all node info
+            data_len, val, data_type = cur_field.from_raw(data, raw, offs)#all node info
             if isinstance(val, StructureData):
                 val._meta.name = cur_field_name
             setattr(data, cur_field_name, val)
@@ -446,7 +911,20 @@ class Structure(WasmField):
             decoder_meta['types'][cur_field_name] = data_type
             #print(self.__class__.__name__,cur_field.__class__.__name__+str(cur_field._type_id),cur_field_name,data_len)
             offs += data_len
-        return offs, data, self
+        return offs - start, data, self
+
+    def lazy_data(self, raw, offs, length):
+        """
+        Creates a data object for the `length` bytes at `raw[offs]`, decoding
+        its fields only once one of them is accessed. Until then, it is
+        serialized as those bytes.
+        """
+        data = self._meta.data_class.__new__(self._meta.data_class)
+        data._decoder_meta = {'lengths': {}, 'types': {}}
+        data._cache = raw[offs:offs + length]
+        data._dirty = False
+        data._lazy = (self, raw, offs)
+        return data
  
     def to_string(self, value):
         lines = ['- [ {}'.format(self.__class__.__name__)]
@@ -467,15 +945,25 @@ class Structure(WasmField):
         return '\n'.join(lines)
 
     def rebuild(self,value):
-        #data = self._meta.data_class(for_decoding=True)._decoder_meta
-        #print(data)
-        buf = b''
+        if not value._dirty and value._cache is not None:
+            return value._cache
+        out = bytearray()
+        self.rebuild_into(value, out)
+        return out
+
+    def rebuild_into(self, value, out):
+        # Structures not touched by a mutation (see `fixup_nodes`, which marks
+        # the fixed ones dirty) are serialized only once, later rebuilds
+        # splice in the cached bytes.
+        dirty = value._dirty
+        if not dirty and value._cache is not None:
+            out += value._cache
+            return
+        start = len(out)
+        field_types = value._decoder_meta['types']
         for cur_field_name, cur_field in self._meta.fields:
-            #print(cur_field_name, cur_field)
-            field_val = getattr(value, cur_field_name)
-            field_type = value.get_decoder_meta()['types'][cur_field_name]
-            #print(field_type,field_val)
-            buf += field_type.rebuild(field_val)
-        return buf
+            field_types[cur_field_name].rebuild_into(getattr(value, cur_field_name), out)
+        if not dirty:
+            value._cache = memoryview(out)[start:].tobytes()
     def fix(self,value):
         pass
@@ -0,0 +1,380 @@
+"""Validates function bodies against the types of the operand stack."""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+from bisect import bisect_right
+from collections import defaultdict
+from .decode import decode_module, decode_bytecode_bulk
+from .modtypes import (
+    SEC_TYPE, SEC_IMPORT, SEC_FUNCTION, SEC_TABLE, SEC_MEMORY, SEC_GLOBAL,
+    SEC_CODE,
+)
+from .opcodes import OPCODES, OPCODE_TABLE
+from .types import decode_leb128_run
+from .wasmtypes import (
+    VAL_TYPE_I32, VAL_TYPE_I64, VAL_TYPE_F32, VAL_TYPE_F64, LANG_TYPE_EMPTY,
+)
+
+
+I32 = VAL_TYPE_I32
+I64 = VAL_TYPE_I64
+F32 = VAL_TYPE_F32
+F64 = VAL_TYPE_F64
+VALUE_TYPES = (I32, I64, F32, F64)
+
+# Operand stack states recorded by `validate_function` besides value types.
+STACK_EMPTY = 0     # nothing on the stack of the current block
+STACK_ANY = 1       # unreachable code, the stack is polymorphic
+
+
+class ValidationError(Exception):
+    pass
+
+
+_NUMERIC_TYPES = {'i32': I32, 'i64': I64, 'f32': F32, 'f64': F64}
+_UNARY = {'clz', 'ctz', 'popcnt', 'abs', 'neg', 'ceil', 'floor', 'trunc', 'nearest', 'sqrt'}
+_BINARY = {
+    'add', 'sub', 'mul', 'div', 'div_s', 'div_u', 'rem_s', 'rem_u', 'and', 'or', 'xor',
+    'shl', 'shr_s', 'shr_u', 'rotl', 'rotr', 'min', 'max', 'copysign',
+}
+_COMPARE = {
+    'eq', 'ne', 'lt', 'lt_s', 'lt_u', 'gt', 'gt_s', 'gt_u',
+    'le', 'le_s', 'le_u', 'ge', 'ge_s', 'ge_u',
+}
+
+
+def _stack_signature(opcode):
+    """
+    Derives the `(params, results)` value types of an instruction from its
+    mnemonic, or returns None if they depend on the context.
+    """
+    mnemonic = opcode.mnemonic
+    if mnemonic == 'current_memory':
+        return (), (I32,)
+    if mnemonic == 'grow_memory':
+        return (I32,), (I32,)
+    prefix, _, op = mnemonic.partition('.')
+    t = _NUMERIC_TYPES.get(prefix)
+    if t is None:
+        return None
+    if '/' in op:
+        return (_NUMERIC_TYPES[op.split('/')[1]],), (t,)
+    if op == 'const':
+        return (), (t,)
+    if op.startswith('load'):
+        return (I32,), (t,)
+    if op.startswith('store'):
+        return (I32, t), ()
+    if op == 'eqz':
+        return (t,), (I32,)
+    if op in _UNARY:
+        return (t,), (t,)
+    if op in _BINARY:
+        return (t, t), (t,)
+    if op in _COMPARE:
+        return (t, t), (I32,)
+    raise ValueError("unknown instruction {}".format(mnemonic))
+
+
+def _natural_alignment(opcode):
+    """Returns log2 of the access size of a load or store, or None."""
+    prefix, _, op = opcode.mnemonic.partition('.')
+    if not op.startswith(('load', 'store')):
+        return None
+    bits = op.lstrip('loadstore').split('_')[0]
+    return {'8': 0, '16': 1, '32': 2, '': 2 if prefix in ('i32', 'f32') else 3}[bits]
+
+
+# `(params, results)` by opcode byte, `None` where they depend on the context.
+STACK_SIGNATURES = [None if x is None else _stack_signature(x) for x in OPCODE_TABLE]
+
+# Natural alignment by opcode byte for loads and stores.
+MEMORY_ALIGNMENTS = [None if x is None else _natural_alignment(x) for x in OPCODE_TABLE]
+
+# Opcodes with a fixed stack signature, grouped by it.
+OPCODES_BY_SIGNATURE = defaultdict(list)
+for cur_op in OPCODES:
+    if STACK_SIGNATURES[cur_op.id] is not None:
+        OPCODES_BY_SIGNATURE[STACK_SIGNATURES[cur_op.id]].append(cur_op.id)
+
+
+class ModuleContext(object):
+    """
+    The parts of a module the instructions of a function body refer to,
+    collected from its decoded `Section`s.
+    """
+    def __init__(self, sections):
+        self.types = []
+        self.funcs = []             # type index by function index
+        self.globals = []           # `(type, mutability)` by global index
+        self.tables = 0
+        self.memories = 0
+        self.imported_funcs = 0
+
+        for sec in sections:
+            payload = sec.payload
+            if sec.id == SEC_TYPE:
+                for entry in payload.entries:
+                    results = (entry.return_type,) if entry.return_count else ()
+                    self.types.append((tuple(entry.param_types), results))
+            elif sec.id == SEC_IMPORT:
+                for entry in payload.entries:
+                    if entry.kind == 0:
+                        self.funcs.append(entry.type.type)
+                        self.imported_funcs += 1
+                    elif entry.kind == 1:
+                        self.tables += 1
+                    elif entry.kind == 2:
+                        self.memories += 1
+                    elif entry.kind == 3:
+                        self.globals.append((entry.type.content_type, entry.type.mutability))
+            elif sec.id == SEC_FUNCTION:
+                self.funcs.extend(payload.types)
+            elif sec.id == SEC_TABLE:
+                self.tables += len(payload.entries)
+            elif sec.id == SEC_MEMORY:
+                self.memories += len(payload.entries)
+            elif sec.id == SEC_GLOBAL:
+                for entry in payload.globals:
+                    self.globals.append((entry.type.content_type, entry.type.mutability))
+
+    def type_of(self, type_index):
+        if type_index >= len(self.types):
+            raise ValidationError("unknown type {}".format(type_index))
+        return self.types[type_index]
+
+    def func_type(self, func_index):
+        if func_index >= len(self.funcs):
+            raise ValidationError("unknown function {}".format(func_index))
+        return self.type_of(self.funcs[func_index])
+
+    def function(self, body_index, body):
+        """Returns the `FunctionContext` of the `body_index`th `FunctionBody`."""
+        return FunctionContext(
+            self, self.func_type(self.imported_funcs + body_index), body.locals,
+        )
+
+
+class FunctionContext(object):
+    """A function's signature and locals within its `ModuleContext`."""
+    def __init__(self, module, func_type, locals):
+        self.module = module
+        self.params, self.results = func_type
+        # locals as runs of a type, the parameters first
+        self.local_ends = []
+        self.local_types = []
+        count = 0
+        for t in self.params:
+            count += 1
+            self.local_ends.append(count)
+            self.local_types.append(t)
+        for entry in locals:
+            count += entry.count
+            self.local_ends.append(count)
+            self.local_types.append(entry.type)
+        self.local_count = count
+        # (code, operand stack states) last recorded, see `InstructionIndex.stack_tops`
+        self.tops = None
+
+    def local_type(self, index):
+        if index >= self.local_count:
+            raise ValidationError("unknown local {}".format(index))
+        return self.local_types[bisect_right(self.local_ends, index)]
+
+
+class _Frame(object):
+    __slots__ = ('opcode', 'labels', 'results', 'height', 'unreachable')
+
+    def __init__(self, opcode, labels, results, height):
+        self.opcode = opcode
+        self.labels = labels
+        self.results = results
+        self.height = height
+        self.unreachable = False
+
+
+def _block_results(sig):
+    if sig == LANG_TYPE_EMPTY:
+        return ()
+    if sig not in VALUE_TYPES:
+        raise ValidationError("invalid block type {}".format(sig))
+    return (sig,)
+
+
+def validate_function(code, function, tops=None):
+    """
+    Validates the bytecode `code` of a function in its `FunctionContext`,
+    raising `ValidationError` on the first type error. If `tops` is given,
+    the state of the operand stack before each instruction is appended to
+    it: the value type on top of the current block's stack, `STACK_EMPTY`
+    or `STACK_ANY`. Instructions up to an error are recorded.
+    """
+    module = function.module
+    insns = decode_bytecode_bulk(code)
+    if insns.end != len(code):
+        raise ValidationError("undecodable instruction at {}".format(insns.end))
+
+    vals = []
+    ctrls = [_Frame(None, function.results, function.results, 0)]
+
+    def pop(expect=None):
+        frame = ctrls[-1]
+        if len(vals) == frame.height:
+            if frame.unreachable:
+                return expect
+            raise ValidationError("operand stack underflow")
+        actual = vals.pop()
+        if expect is not None and actual != expect:
+            raise ValidationError("type mismatch")
+        return actual
+
+    def pop_all(types):
+        for t in reversed(types):
+            pop(t)
+
+    def set_unreachable():
+        frame = ctrls[-1]
+        del vals[frame.height:]
+        frame.unreachable = True
+
+    def labels(depth):
+        if depth >= len(ctrls):
+            raise ValidationError("invalid branch depth {}".format(depth))
+        return ctrls[-1 - depth].labels
+
+    for i, op in enumerate(insns.op):
+        if not ctrls:
+            raise ValidationError("instructions after the end of the function")
+        if tops is not None:
+            frame = ctrls[-1]
+            if len(vals) > frame.height:
+                tops.append(vals[-1])
+            else:
+                tops.append(STACK_ANY if frame.unreachable else STACK_EMPTY)
+
+        imm0 = insns.imm0[i]
+        sig = STACK_SIGNATURES[op]
+        if sig is not None:
+            if MEMORY_ALIGNMENTS[op] is not None or op in (0x3f, 0x40):
+                if not module.memories:
+                    raise ValidationError("memory access without a memory")
+                if MEMORY_ALIGNMENTS[op] is not None and imm0 > MEMORY_ALIGNMENTS[op]:
+                    raise ValidationError("alignment larger than natural")
+            params, results = sig
+            pop_all(params)
+            vals.extend(results)
+        elif op == 0x00:    # unreachable
+            set_unreachable()
+        elif op == 0x01:    # nop
+            pass
+        elif op in (0x02, 0x03, 0x04):    # block, loop, if
+            results = _block_results(imm0)
+            if op == 0x04:
+                pop(I32)
+            ctrls.append(_Frame(op, () if op == 0x03 else results, results, len(vals)))
+        elif op == 0x05 or op == 0x0b:    # else, end
+            frame = ctrls[-1]
+            pop_all(frame.results)
+            if len(vals) != frame.height:
+                raise ValidationError("values left on the operand stack")
+            ctrls.pop()
+            if op == 0x05:
+                if frame.opcode != 0x04:
+                    raise ValidationError("else without if")
+                ctrls.append(_Frame(0x05, frame.labels, frame.results, frame.height))
+            else:
+                if frame.opcode == 0x04 and frame.results:
+                    raise ValidationError("if with a result but without else")
+                vals.extend(frame.results)
+        elif op == 0x0c:    # br
+            pop_all(labels(imm0))
+            set_unreachable()
+        elif op == 0x0d:    # br_if
+            pop(I32)
+            types = labels(imm0)
+            pop_all(types)
+            vals.extend(types)
+        elif op == 0x0e:    # br_table
+            _, targets = decode_leb128_run(code, insns.offset[i] + 1, imm0 + 2)
+            pop(I32)
+            types = labels(targets[-1])
+            for depth in targets[1:-1]:
+                if len(labels(depth)) != len(types):
+                    raise ValidationError("br_table targets of different arity")
+            pop_all(types)
+            set_unreachable()
+        elif op == 0x0f:    # return
+            pop_all(function.results)
+            set_unreachable()
+        elif op == 0x10:    # call
+            params, results = module.func_type(imm0)
+            pop_all(params)
+            vals.extend(results)
+        elif op == 0x11:    # call_indirect
+            if not module.tables:
+                raise ValidationError("call_indirect without a table")
+            params, results = module.type_of(imm0)
+            pop(I32)
+            pop_all(params)
+            vals.extend(results)
+        elif op == 0x1a:    # drop
+            pop()
+        elif op == 0x1b:    # select
+            pop(I32)
+            t = pop()
+            t = pop(t)
+            if t is not None:
+                vals.append(t)
+            else:
+                # both operands from unreachable code
+                set_unreachable()
+        elif op == 0x20:    # get_local
+            vals.append(function.local_type(imm0))
+        elif op == 0x21:    # set_local
+            pop(function.local_type(imm0))
+        elif op == 0x22:    # tee_local
+            t = function.local_type(imm0)
+            pop(t)
+            vals.append(t)
+        elif op == 0x23:    # get_global
+            if imm0 >= len(module.globals):
+                raise ValidationError("unknown global {}".format(imm0))
+            vals.append(module.globals[imm0][0])
+        elif op == 0x24:    # set_global
+            if imm0 >= len(module.globals):
+                raise ValidationError("unknown global {}".format(imm0))
+            t, mutability = module.globals[imm0]
+            if not mutability:
+                raise ValidationError("set_global of an immutable global")
+            pop(t)
+        else:
+            raise ValidationError("unsupported instruction {}".format(OPCODE_TABLE[op].mnemonic))
+
+    if ctrls:
+        raise ValidationError("function body not terminated by end")
+
+
+def validate_module(module):
+    """
+    Validates the function bodies of the raw WASM module `module`, raising
+    `ValidationError` for them or for any other part that fails to decode.
+    """
+    try:
+        sections = [x.data for x in decode_module(module)][1:]
+        context = ModuleContext(sections)
+        bodies = []
+        for sec in sections:
+            if sec.id == SEC_CODE:
+                bodies.extend(sec.payload.bodies)
+        codes = [bytearray(x.code) for x in bodies]
+    except ValidationError:
+        raise
+    except Exception as e:
+        raise ValidationError("malformed module: {!r}".format(e))
+
+    if len(bodies) != len(context.funcs) - context.imported_funcs:
+        raise ValidationError("function and code section counts differ")
+    for i, (body, code) in enumerate(zip(bodies, codes)):
+        try:
+            validate_function(code, context.function(i, body))
+        except ValidationError as e:
+            raise ValidationError("function {}: {}".format(i, e))
@@ -1,151 +1,542 @@
 import random
+import collections
+from array import array
 from wasm.formatter import *
 from wasm.decode import *
-from wasm.opcodes import OPCODES
-import binascii
+from wasm.opcodes import OPCODES, OPCODE_TABLE, INSN_ENTER_BLOCK, INSN_LEAVE_BLOCK
+from wasm.types import write_signed_leb128, write_unsigned_leb128, decode_leb128_run, encode_padded_leb128
+from wasm.validate import *
+from wasm.lrucache import LRUCache
+from mutator import growth_allowance
 
 
 # Parameter
-variableInstruction = ['20', '21', '22', '23', '24']
-memoryInstruction = ['28', '29', '2a', '2b', '2c', '2d', '2e', '2f', '31', '32', '33', '34', '35', '36', '37', '38', '39', '3a', '3b', '3c', '3d', '3e']
-constInstruction = ['41', '42', '43', '44']
+variableInstruction = [0x20, 0x21, 0x22, 0x23, 0x24]
+memoryInstruction = list(range(0x28, 0x3f))
+constInstruction = [0x41, 0x42, 0x43, 0x44]
 # No Parameter
-numericInstruction = ['45', '46', '47', '48', '49', '4a', '4b', '4c', '4d', '4e', '4f', 
-                      '50', '51', '52', '53', '54', '55', '56', '57', '58', '59', '5a', '5b', '5c', '5d', '5e', '5f',
-                      '60', '61', '62', '63', '64', '65', '66', '67', '68', '69', '6a', '6b', '6c', '6d', '6e', '6f',
-                      '70', '71', '72', '73', '74', '75', '76', '77', '78', '79', '7a', '7b', '7c', '7d', '7e', '7f',
-                      '80', '81', '82', '83', '84', '85', '86', '87', '88', '89', '8a', '8b', '8c', '8d', '8e', '8f',
-                      '90', '91', '92', '93', '94', '95', '96', '97', '98', '99', '9a', '9b', '9c', '9d', '9e', '9f',
-                      'a0', 'a1', 'a2', 'a3', 'a4', 'a5', 'a6', 'a7', 'a8', 'a9', 'aa', 'ab', 'ac', 'ad', 'ae', 'af',
-                      'b0', 'b1', 'b2', 'b3', 'b4', 'b5', 'b6', 'b7', 'b8', 'b9', 'ba', 'bb', 'bc', 'bd', 'be', 'bf']
+numericInstruction = list(range(0x45, 0xc0))
+# Control Flow
+branchInstruction = [0x0c, 0x0d, 0x0e]
 
 InstructionList = ["variableInstruction", "memoryInstruction", "constInstruction", "numericInstruction"]
 
+# Opcodes sharing the immediate layout and stack signature of an opcode, by opcode byte
+compatibleClasses = collections.defaultdict(list)
+for cur_op in OPCODES:
+    if STACK_SIGNATURES[cur_op.id] is not None:
+        compatibleClasses[(IMM_LAYOUT_TABLE[cur_op.id], STACK_SIGNATURES[cur_op.id])].append(cur_op.id)
+compatibleInstruction = [[] for _ in range(256)]
+for cur_class in compatibleClasses.values():
+    for cur_op in cur_class:
+        compatibleInstruction[cur_op] = [x for x in cur_class if x != cur_op]
+# Replaceable
+replaceableInstruction = [x for x in range(256) if compatibleInstruction[x]]
 
-# Insert Instruction
-def insertInstruction(wasm_bytes):
-    wasm_byte_len = len(wasm_bytes)
-    if wasm_byte_len < 4:
-        return bytearray(binascii.unhexlify(wasm_bytes))
-    
-    index = random.randint(1, wasm_byte_len - 2)
-    insert_position = index + index % 2
-    
-    item = random.choice(InstructionList)
-    if item == "numericInstruction":
-        random_inst = random.choice(numericInstruction)
-        new_instruction = random_inst
-        wasm_bytes = wasm_bytes[:insert_position] + new_instruction + wasm_bytes[insert_position:]
-    elif item == "variableInstruction":
-        random_inst = random.choice(variableInstruction)
-        random_byte = random.randint(0x00, 0xff)
-        hex_random_byte = format(random_byte, '02x')
-        new_instruction = random_inst + hex_random_byte
-        wasm_bytes = wasm_bytes[:insert_position] + new_instruction + wasm_bytes[insert_position:]
-    elif item == "memoryInstruction":
-        random_inst = random.choice(memoryInstruction)
-        random_byte = random.randint(0x00, 0xff)
-        hex_random_byte = format(random_byte, '02x')
-        new_instruction = random_inst + hex_random_byte
-        wasm_bytes = wasm_bytes[:insert_position] + new_instruction + wasm_bytes[insert_position:]
-    elif item == "constInstruction":
-        random_inst = random.choice(constInstruction)
-        random_byte = random.randint(0x00, 0xff)
-        hex_random_byte = format(random_byte, '02x')
-        new_instruction = random_inst + hex_random_byte
-        wasm_bytes = wasm_bytes[:insert_position] + new_instruction + wasm_bytes[insert_position:]
+InstructionCategories = {
+    "variableInstruction": variableInstruction,
+    "memoryInstruction": memoryInstruction,
+    "constInstruction": constInstruction,
+    "numericInstruction": numericInstruction,
+    "branchInstruction": branchInstruction,
+    "replaceableInstruction": replaceableInstruction,
+}
 
-    wasm_bytearray = bytearray(wasm_bytes.encode('utf-8')).replace(b'\\\\', b'\\')
-    
-    return bytearray(binascii.unhexlify(bytes(wasm_bytearray)))
+BlockNesting = collections.namedtuple('BlockNesting', 'depths parents ends starts')
 
+# Instruction index cache, see `instruction_index`
+INSN_INDEX_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# measured footprint of an index with its block nesting and categories: per entry and per code byte
+INSN_INDEX_ENTRY_COST = 3400
+INSN_INDEX_BYTE_COST = 60
 
-# Delete Instruction
-def eraseInstruction(wasm_bytes):
-    wasm_byte_len = len(wasm_bytes)
-    if wasm_byte_len < 4:
-        return bytearray(binascii.unhexlify(wasm_bytes))
-
-    formate_wasm_byte = ''.join('\\x' + wasm_bytes[i:i+2] for i in range(0, len(wasm_bytes), 2))
-
-    item = random.choice(InstructionList)
-    if item == "numericInstruction":
-        random_inst = '\\x' + random.choice(numericInstruction)
-        offset = formate_wasm_byte.find(random_inst)
-        if offset != -1:
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(random_inst):]
-    elif item == "variableInstruction":
-        random_inst = '\\x' + random.choice(variableInstruction)
-        offset = formate_wasm_byte.find(random_inst)
-        if offset != -1:
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(random_inst) + 4:]
+
+class InstructionIndex(object):
+    """Instruction boundaries of a function body's code, see `decode_bytecode_bulk`."""
+    def __init__(self, code):
+        self.code = code
+        self.insns = decode_bytecode_bulk(code)
+        self.by_category = {}
+        self.blocks = None
+
+    def nesting(self):
+        """
+        Returns the `BlockNesting` of the body: by instruction, the number of
+        enclosing blocks (not counting the function) and the number of the
+        innermost enclosing `block`, `loop` or `if` (or -1), with those and
+        their `else` and `end` counted to the outer level; the number of the
+        matching `end` by block start and the block starts. Instructions are
+        indexed up to the first one that does not nest.
+        """
+        if self.blocks is not None:
+            return self.blocks
+
+        depths = array('L')
+        parents = array('l')
+        ends = {}
+        opened = []
+        ops = self.insns.op
+        for i, op in enumerate(ops):
+            flags = OPCODE_TABLE[op].flags
+            if flags & INSN_LEAVE_BLOCK:
+                if flags & INSN_ENTER_BLOCK:
+                    # else
+                    if not opened or ops[opened[-1]] != 0x04:
+                        break
+                    depths.append(len(opened) - 1)
+                    parents.append(opened[-2] if len(opened) > 1 else -1)
+                    continue
+                if not opened:
+                    # the end of the function
+                    depths.append(0)
+                    parents.append(-1)
+                    break
+                ends[opened.pop()] = i
+            depths.append(len(opened))
+            parents.append(opened[-1] if opened else -1)
+            if flags & INSN_ENTER_BLOCK:
+                opened.append(i)
+
+        self.blocks = BlockNesting(depths, parents, ends, sorted(ends))
+        return self.blocks
+
+    def stack_tops(self, function):
+        """
+        Returns the operand stack state before each instruction in the
+        `FunctionContext` `function`, see `validate_function`. They depend on
+        the module, so they are kept with the function rather than here.
+        """
+        if function.tops is not None and function.tops[0] is self.code:
+            return function.tops[1]
+        tops = []
+        try:
+            validate_function(self.code, function, tops)
+        except ValidationError:
+            # the body is well-typed up to the last recorded instruction
+            pass
+        function.tops = (self.code, tops)
+        return tops
+
+    def choose(self, item):
+        """Returns the number of a random instruction of a category, or None."""
+        positions = self.by_category.get(item)
+        if positions is None:
+            ops = frozenset(InstructionCategories[item])
+            positions = [i for i, op in enumerate(self.insns.op) if op in ops]
+            self.by_category[item] = positions
+        if not positions:
+            return None
+        return random.choice(positions)
+
+
+insn_index_cache = LRUCache(
+    INSN_INDEX_CACHE_MAX_BYTES,
+    lambda key, index: INSN_INDEX_ENTRY_COST + len(key) * INSN_INDEX_BYTE_COST,
+)
+
+def instruction_index(code):
+    """
+    Returns the `InstructionIndex` of the bytearray `code`. Indexes are cached
+    by content, so a body is decoded once however often a seed is fuzzed.
+    """
+    return insn_index_cache.get(bytes(code), InstructionIndex)
+
+
+def randomInstruction(item):
+    """Encodes a random instruction of a category with well-formed immediates."""
+    opcode = random.choice(InstructionCategories[item])
+    insn = bytearray([opcode])
+    if item == "variableInstruction":
+        insn.append(random.randint(0x00, 0x7f))
     elif item == "memoryInstruction":
-        random_inst = '\\x' + random.choice(memoryInstruction)
-        offset = formate_wasm_byte.find(random_inst)
-        if offset != -1:
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(random_inst) + 4:]
+        # alignment, offset
+        insn.append(random.randint(0x00, 0x03))
+        insn.append(random.randint(0x00, 0x7f))
     elif item == "constInstruction":
-        random_inst = '\\x' + random.choice(constInstruction)
-        offset = formate_wasm_byte.find(random_inst)
-        if offset != -1:
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(random_inst) + 4:]
+        if opcode == 0x43:
+            insn.extend(random.randint(0x00, 0xff) for _ in range(4))
+        elif opcode == 0x44:
+            insn.extend(random.randint(0x00, 0xff) for _ in range(8))
+        else:
+            insn.append(random.randint(0x00, 0x7f))
+    return insn
+
+
+# Typed instruction synthesis
+INTERESTING_CONSTS = [0, 1, -1, 16, 32, 64, 100, 127, 128, 255, 256, 1024, 4096,
+                      0x7fff, -0x8000, 0xffff, 0x7fffffff, -0x80000000]
+CONST_OPCODES = {I32: 0x41, I64: 0x42, F32: 0x43, F64: 0x44}
+
+
+def plainOpcodes(params, results):
+    """Opcodes without immediates of the stack signature `params` -> `results`."""
+    return [op for op in OPCODES_BY_SIGNATURE[(params, results)] if OPCODE_TABLE[op].imm_struct is None]
+
+
+def memoryOpcodes(params, results):
+    """Loads or stores of the stack signature `params` -> `results`."""
+    return [op for op in OPCODES_BY_SIGNATURE[(params, results)] if MEMORY_ALIGNMENTS[op] is not None]
+
+
+def constEncoding(t):
+    insn = bytearray([CONST_OPCODES[t]])
+    if t == F32:
+        insn.extend(random.randint(0x00, 0xff) for _ in range(4))
+    elif t == F64:
+        insn.extend(random.randint(0x00, 0xff) for _ in range(8))
+    elif random.randint(0, 1):
+        write_signed_leb128(insn, random.choice(INTERESTING_CONSTS))
+    else:
+        write_signed_leb128(insn, random.randint(-0x80, 0x7f))
+    return insn
+
+
+def memoryEncoding(opcode):
+    insn = bytearray([opcode])
+    # alignment, offset
+    insn.append(random.randint(0, MEMORY_ALIGNMENTS[opcode]))
+    insn.append(random.randint(0x00, 0x7f))
+    return insn
+
+
+def transformInstructions(t):
+    """Encodes instructions taking a `t` off the operand stack and leaving a `t`."""
+    unary = plainOpcodes((t,), (t,))
+    binary = plainOpcodes((t, t), (t,))
+    conversions = [
+        (a, b)
+        for u in VALUE_TYPES if u != t
+        for a in plainOpcodes((t,), (u,))
+        for b in plainOpcodes((u,), (t,))
+    ]
+    item = random.choice([x for x, ops in (("unary", unary), ("binary", binary), ("conversion", conversions)) if ops])
+    if item == "unary":
+        return bytearray([random.choice(unary)])
+    elif item == "binary":
+        return constEncoding(t) + bytearray([random.choice(binary)])
+    else:
+        return bytearray(random.choice(conversions))
+
+
+def neutralInstructions(function):
+    """Encodes instructions leaving the operand stack as it is."""
+    module = function.module
+    items = ["const"]
+    if function.local_count:
+        items.append("local")
+    if any(mutability and t in VALUE_TYPES for t, mutability in module.globals):
+        items.append("global")
+    if module.memories:
+        items += ["load", "store"]
+
+    item = random.choice(items)
+    t = random.choice(VALUE_TYPES)
+    if item == "const":
+        return constEncoding(t) + bytearray([0x1a])
+    elif item == "local":
+        # get_local x; <transform>; set_local x
+        index = random.randrange(function.local_count)
+        if function.local_type(index) not in VALUE_TYPES:
+            return constEncoding(t) + bytearray([0x1a])
+        ref = bytearray()
+        write_unsigned_leb128(ref, index)
+        return (bytearray([0x20]) + ref + transformInstructions(function.local_type(index)) +
+                bytearray([0x21]) + ref)
+    elif item == "global":
+        index = random.choice([i for i, (gt, mutability) in enumerate(module.globals)
+                               if mutability and gt in VALUE_TYPES])
+        ref = bytearray()
+        write_unsigned_leb128(ref, index)
+        return (bytearray([0x23]) + ref + transformInstructions(module.globals[index][0]) +
+                bytearray([0x24]) + ref)
+    address = bytearray([0x41])
+    write_signed_leb128(address, random.choice([0, random.randint(0x00, 0xffff)]))
+    if item == "load":
+        return address + memoryEncoding(random.choice(memoryOpcodes((I32,), (t,)))) + bytearray([0x1a])
+    else:
+        return address + constEncoding(t) + memoryEncoding(random.choice(memoryOpcodes((I32, t), ())))
+
+
+def typedInstructions(function, top):
+    """
+    Encodes a random instruction sequence that keeps a function well-typed
+    when inserted where the operand stack is in the state `top` (see
+    `validate_function`): it either works on the value on top of the stack
+    or leaves the stack alone.
+    """
+    if top in VALUE_TYPES and random.randint(0, 1):
+        return transformInstructions(top)
+    return neutralInstructions(function)
+
 
-    formate_wasm_byte = formate_wasm_byte.replace("\\x", "")
-    wasm_bytearray = bytearray(formate_wasm_byte.encode('utf-8')).replace(b'\\\\', b'\\')
+# The mutators below edit the bytearray `code` of a function body in place
+# at instruction boundaries and return the change of its length. Given the
+# body's `FunctionContext`, inserted instructions are typed to fit in. The
+# growing ones stay within the size budget (see `growth_allowance`) and do
+# a non-growing mutation instead when there is no room.
 
-    return bytearray(binascii.unhexlify(bytes(wasm_bytearray)))
+# Insert Instruction
+def insertInstruction(code, function=None):
+    index = instruction_index(code)
+    insns = index.insns
+    if not insns.offset:
+        return 0
+
+    if function is None:
+        insert_position = random.choice(insns.offset)
+        new_instruction = randomInstruction(random.choice(InstructionList))
+    else:
+        tops = index.stack_tops(function)
+        if not tops:
+            return 0
+        i = random.randrange(len(tops))
+        insert_position = insns.offset[i]
+        new_instruction = typedInstructions(function, tops[i])
+    if growth_allowance(len(new_instruction), partial=False) == 0:
+        # no room to grow, replace an instruction instead
+        return replaceInstruction(code, function)
+    code[insert_position:insert_position] = new_instruction
+    return len(new_instruction)
+
+
+# Delete Instruction
+def eraseInstruction(code, function=None):
+    index = instruction_index(code)
+    i = index.choose(random.choice(InstructionList))
+    if i is None:
+        return 0
+
+    offset = index.insns.offset[i]
+    length = index.insns.len[i]
+    code[offset:offset + length] = b''
+    return -length
 
 
 # Move Instruction
-def moveInstruction(wasm_bytes):
-    wasm_byte_len = len(wasm_bytes)
-    if wasm_byte_len < 4:
-        return bytearray(binascii.unhexlify(wasm_bytes))
-    
-    formate_wasm_byte = ''.join('\\x' + wasm_bytes[i:i+2] for i in range(0, len(wasm_bytes), 2))
-
-    index = random.randint(1, wasm_byte_len - 2)
-    move_position = index + index % 2
-
-    item = random.choice(InstructionList)
-    if item == "numericInstruction":
-        radom_inst = '\\x' + random.choice(numericInstruction)
-        offset = formate_wasm_byte.find(radom_inst)
-        if offset != -1:
-            instruction = formate_wasm_byte[offset:offset + len(radom_inst)]
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(radom_inst):]
-            formate_wasm_byte = formate_wasm_byte[:move_position] + instruction + formate_wasm_byte[move_position:]
-    elif item == "variableInstruction":
-        radom_inst = '\\x' + random.choice(variableInstruction)
-        offset = formate_wasm_byte.find(radom_inst)
-        if offset != -1:
-            instruction = formate_wasm_byte[offset:offset + len(radom_inst) + 4]
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(radom_inst) + 4:]
-            formate_wasm_byte = formate_wasm_byte[:move_position] + instruction + formate_wasm_byte[move_position:]
-    elif item == "memoryInstruction":
-        radom_inst = '\\x' + random.choice(memoryInstruction)
-        offset = formate_wasm_byte.find(radom_inst)
-        if offset != -1:
-            instruction = formate_wasm_byte[offset:offset + len(radom_inst) + 4]
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(radom_inst) + 4:]
-            formate_wasm_byte = formate_wasm_byte[:move_position] + instruction + formate_wasm_byte[move_position:]
-    elif item == "constInstruction":
-        radom_inst = '\\x' + random.choice(constInstruction)
-        offset = formate_wasm_byte.find(radom_inst)
-        if offset != -1:
-            instruction = formate_wasm_byte[offset:offset + len(radom_inst) + 4]
-            formate_wasm_byte = formate_wasm_byte[:offset] + formate_wasm_byte[offset + len(radom_inst) + 4:]
-            formate_wasm_byte = formate_wasm_byte[:move_position] + instruction + formate_wasm_byte[move_position:]
-
-    formate_wasm_byte = formate_wasm_byte.replace("\\x", "")
-    wasm_bytearray = bytearray(formate_wasm_byte.encode('utf-8')).replace(b'\\\\', b'\\')
-    
-    return bytearray(binascii.unhexlify(bytes(wasm_bytearray)))
-
-
-# TODO: Replace Instruction
-def replaceInstruction(wasm_bytes):
-    wasm_byte_len = len(wasm_bytes)
-    if wasm_byte_len < 4:
-        return wasm_bytes
-    
+def moveInstruction(code, function=None):
+    index = instruction_index(code)
+    i = index.choose(random.choice(InstructionList))
+    if i is None:
+        return 0
+
+    offset = index.insns.offset[i]
+    end = offset + index.insns.len[i]
+    move_position = random.choice(index.insns.offset)
+    if move_position < offset:
+        code[move_position:end] = code[offset:end] + code[move_position:offset]
+    elif move_position > end:
+        code[offset:move_position] = code[end:move_position] + code[offset:end]
+    return 0
+
+
+# Control flow mutations, on the block structure of a body
+
+def labelTypes(index, i, function=None):
+    """
+    Returns the result types of the labels a branch at instruction `i` can
+    target, by depth; the function's is None without its `FunctionContext`.
+    """
+    nesting = index.nesting()
+    ops = index.insns.op
+    imm0 = index.insns.imm0
+    labels = []
+    start = nesting.parents[i]
+    while start >= 0:
+        if ops[start] == 0x03 or imm0[start] == LANG_TYPE_EMPTY:
+            labels.append(())
+        else:
+            labels.append((imm0[start],))
+        start = nesting.parents[start]
+    labels.append(function.results if function is not None else None)
+    return labels
+
+
+def shiftedBranches(code, index, i, j, delta):
+    """
+    Copies instructions `i` to `j` of `code`, adding `delta` to the depth of
+    the branches in it that leave the copied range.
+    """
+    insns = index.insns
+    depths = index.nesting().depths
+    out = bytearray()
+    pos = insns.offset[i]
+    for k in range(i, j):
+        if insns.op[k] not in branchInstruction:
+            continue
+        # blocks of the range enclosing the branch
+        inner = depths[k] - depths[i]
+        offset = insns.offset[k]
+        out += code[pos:offset + 1]
+        if insns.op[k] == 0x0e:
+            _, targets = decode_leb128_run(code, offset + 1, insns.imm0[k] + 2)
+            write_unsigned_leb128(out, targets[0])
+            targets = targets[1:]
+        else:
+            targets = [insns.imm0[k]]
+        for target in targets:
+            write_unsigned_leb128(out, target + delta if target >= inner else target)
+        pos = offset + insns.len[k]
+    out += code[pos:insns.offset[j]]
+    return out
+
+
+# Wrap Instructions
+def wrapInstructions(code, function=None):
+    """
+    Wraps a range of instructions on one nesting level in a `block`, `loop`
+    or `if`. With a `FunctionContext`, the range starts and ends with an
+    empty operand stack, so the wrapped code stays well-typed.
+    """
+    index = instruction_index(code)
+    nesting = index.nesting()
+    ops = index.insns.op
+    tops = index.stack_tops(function) if function is not None else None
+    count = len(nesting.depths) if tops is None else min(len(nesting.depths), len(tops))
+    if count == 0:
+        return 0
+
+    for _ in range(8):
+        i = random.randrange(count)
+        if ops[i] not in (0x05, 0x0b) and (tops is None or tops[i] == STACK_EMPTY):
+            break
+    else:
+        return 0
+
+    # ends of whole instructions and blocks following `i` on its level
+    boundaries = []
+    k = i
+    while k < count and len(boundaries) < 32:
+        if ops[k] in (0x05, 0x0b):
+            break
+        if k in nesting.ends:
+            k = nesting.ends[k]
+        k += 1
+        if k < count and (tops is None or tops[k] == STACK_EMPTY):
+            boundaries.append(k)
+    if not boundaries:
+        return 0
+    j = random.choice(boundaries)
+
+    item = random.choice(["block", "loop", "if"])
+    if item == "block":
+        head = bytearray([0x02, 0x40])
+    elif item == "loop":
+        head = bytearray([0x03, 0x40])
+    else:
+        head = bytearray([0x41, random.randint(0, 1), 0x04, 0x40])
+    start = index.insns.offset[i]
+    stop = index.insns.offset[j]
+    new_block = head + shiftedBranches(code, index, i, j, 1) + bytearray([0x0b])
+    if growth_allowance(len(new_block) - (stop - start), partial=False) == 0:
+        # no room for the new block, remove one instead
+        return deleteBlock(code, function)
+    code[start:stop] = new_block
+    return len(new_block) - (stop - start)
+
+
+# Duplicate Block
+def duplicateBlock(code, function=None):
+    """Repeats a `block`, `loop` or `if` right after it, dropping its result."""
+    index = instruction_index(code)
+    nesting = index.nesting()
+    if not nesting.starts:
+        return 0
+
+    i = random.choice(nesting.starts)
+    j = nesting.ends[i]
+    start = index.insns.offset[i]
+    stop = index.insns.offset[j] + index.insns.len[j]
+    new_block = bytearray()
+    if index.insns.op[i] == 0x04:
+        # a condition for the copy of an `if`
+        new_block += bytearray([0x41, random.randint(0, 1)])
+    new_block += code[start:stop]
+    if index.insns.imm0[i] != LANG_TYPE_EMPTY:
+        new_block.append(0x1a)
+    if growth_allowance(len(new_block), partial=False) == 0:
+        # no room for the copy, remove a block instead
+        return deleteBlock(code, function)
+    code[stop:stop] = new_block
+    return len(new_block)
+
+
+# Retarget Branch
+def retargetBranch(code, function=None):
+    """
+    Changes the depth of a `br`, `br_if` or `br_table` target to another
+    label around it. With a `FunctionContext`, only to a label of the same
+    result types.
+    """
+    index = instruction_index(code)
+    i = index.choose("branchInstruction")
+    if i is None or i >= len(index.nesting().depths):
+        return 0
+
+    offset = index.insns.offset[i]
+    length = index.insns.len[i]
+    if index.insns.op[i] == 0x0e:
+        _, targets = decode_leb128_run(code, offset + 1, index.insns.imm0[i] + 2)
+        targets = list(targets)
+        slot = random.randrange(1, len(targets))
+    else:
+        targets = [index.insns.imm0[i]]
+        slot = 0
+
+    labels = labelTypes(index, i, function)
+    target = targets[slot]
+    if function is None or target >= len(labels):
+        targets[slot] = random.randrange(len(labels))
+    else:
+        targets[slot] = random.choice([d for d, types in enumerate(labels) if types == labels[target]])
+
+    immediates = bytearray()
+    for target in targets:
+        write_unsigned_leb128(immediates, target)
+    code[offset + 1:offset + length] = immediates
+    return len(immediates) - (length - 1)
+
+
+# Delete Block
+def deleteBlock(code, function=None):
+    """Removes a whole `block`, `loop` or `if`, leaving a constant for its result."""
+    index = instruction_index(code)
+    nesting = index.nesting()
+    if not nesting.starts:
+        return 0
+
+    i = random.choice(nesting.starts)
+    j = nesting.ends[i]
+    start = index.insns.offset[i]
+    stop = index.insns.offset[j] + index.insns.len[j]
+    replacement = bytearray()
+    if index.insns.op[i] == 0x04:
+        # drop the condition
+        replacement.append(0x1a)
+    if index.insns.imm0[i] in VALUE_TYPES:
+        replacement += constEncoding(index.insns.imm0[i])
+    code[start:stop] = replacement
+    return len(replacement) - (stop - start)
+
+
+# Replace Instruction
+def replaceInstruction(code, function=None):
+    """
+    Patches the opcode of an instruction to another one with the same
+    immediates and stack signature, lowering a load or store's alignment
+    hint in place where the new one needs it.
+    """
+    index = instruction_index(code)
+    i = index.choose("replaceableInstruction")
+    if i is None:
+        return 0
+
+    offset = index.insns.offset[i]
+    opcode = random.choice(compatibleInstruction[index.insns.op[i]])
+    code[offset] = opcode
+    alignment = MEMORY_ALIGNMENTS[opcode]
+    if alignment is not None and index.insns.imm0[i] > alignment:
+        width = 1
+        while code[offset + width] & 0x80:
+            width += 1
+        code[offset + 1:offset + 1 + width] = encode_padded_leb128(alignment, width)
+    return 0
@@ -0,0 +1,321 @@
+"""
+Out-of-process mutation: a pool of forked worker processes that mutate the
+current seed ahead of time and hand the mutants over in shared memory.
+"""
+from __future__ import print_function, absolute_import, division
+
+import atexit
+import ctypes
+import errno
+import fcntl
+import mmap
+import os
+import random
+import select
+import signal
+import struct
+import time
+
+
+class MutantRing(object):
+    """
+    Single-producer single-consumer ring of mutants in an anonymous shared
+    mapping, created before forking the producer. The header holds the
+    byte positions the consumer (head) and the producer (tail) are at, each
+    written by one side only and with a single aligned store, so the other
+    side never sees half of an update. Records are a length, the generation
+    of the seed they were made from and the mutant, aligned to 8 bytes; a
+    record that does not fit before the end of the ring is preceded by a
+    wrap marker and goes to its start. A seed the producer fails to mutate
+    is answered with a failure marker in place of a mutant.
+    """
+    header_size = 16
+    record = struct.Struct('<II')
+    wrap_marker = 0xffffffff
+    failure_marker = 0xfffffffe
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.mem = mmap.mmap(-1, self.header_size + capacity)
+        self.head = ctypes.c_uint64.from_buffer(self.mem, 0)
+        self.tail = ctypes.c_uint64.from_buffer(self.mem, 8)
+
+    def put(self, generation, data):
+        """
+        Appends a mutant, or a failure marker if `data` is None. Returns
+        False if there is no room for it now.
+        """
+        if data is None:
+            length, data = self.failure_marker, b''
+        else:
+            length = len(data)
+        size = (self.record.size + len(data) + 7) & ~7
+        if size > self.capacity // 2:
+            # never fits; dropped, the producer makes another one
+            return True
+        head, tail = self.head.value, self.tail.value
+        offs = tail % self.capacity
+        skip = self.capacity - offs if offs + size > self.capacity else 0
+        if tail + skip + size - head > self.capacity:
+            return False
+        base = self.header_size
+        if skip:
+            self.record.pack_into(self.mem, base + offs, self.wrap_marker, 0)
+            offs = 0
+        self.record.pack_into(self.mem, base + offs, length, generation)
+        start = base + offs + self.record.size
+        self.mem[start:start + len(data)] = bytes(data)
+        # publish the record only once it is complete
+        self.tail.value = tail + skip + size
+        return True
+
+    def get(self, generation):
+        """
+        Removes the oldest mutant of `generation` and returns it, None if
+        there is none or False for a failure marker. Mutants of other
+        generations before it are skipped without copying them out.
+        """
+        base = self.header_size
+        tail = self.tail.value
+        while True:
+            head = self.head.value
+            if head == tail:
+                return None
+            offs = head % self.capacity
+            length, record_generation = self.record.unpack_from(self.mem, base + offs)
+            if length == self.wrap_marker:
+                self.head.value = head + self.capacity - offs
+                continue
+            if length == self.failure_marker:
+                self.head.value = head + self.record.size
+                if record_generation != generation:
+                    continue
+                return False
+            size = (self.record.size + length + 7) & ~7
+            if record_generation != generation:
+                self.head.value = head + size
+                continue
+            start = base + offs + self.record.size
+            data = bytearray(self.mem[start:start + length])
+            self.head.value = head + size
+            return data
+
+
+class WorkerPool(object):
+    """
+    Forked processes generating mutants of the current seed with `mutate`
+    while the fuzzer runs the target. Seeds go to the workers through pipes
+    tagged with a generation, mutants come back through one `MutantRing`
+    per worker; mutants of an earlier generation are dropped. Worker `i`
+    seeds its RNGs with `reseed(seed + i)`, so each worker's stream is
+    reproducible, not the order they are taken in.
+
+    A seed `mutate` raises on is mutated locally, so the exception reaches
+    the caller as it would without workers. Workers that are gone are
+    dropped, and with none left, all mutants are made locally.
+
+    The integer values of the dict `counters`, as `mutate` updates them in
+    the workers, are summed up by `counter_totals`.
+    """
+    message = struct.Struct('<II')
+    stop_generation = 0xffffffff
+    min_delay = 0.00005
+    max_delay = 0.001
+    # longest a worker waits for room in its ring before looking again
+    max_idle = 0.05
+    # signals AFLFuzz handles, which workers leave to the default action
+    default_signals = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGALRM, signal.SIGCHLD)
+
+    def __init__(self, mutate, workers, seed, ring_size=16 * 1024 * 1024, reseed=random.seed, counters=None):
+        self.mutate = mutate
+        self.reseed = reseed
+        self.counters = counters if counters is not None else {}
+        self.counter_names = sorted(self.counters)
+        # by worker, the values of `counter_names` in shared memory
+        size = max(len(self.counter_names) * workers, 1)
+        self.counter_mem = mmap.mmap(-1, 8 * size)
+        self.counter_values = (ctypes.c_uint64 * size).from_buffer(self.counter_mem)
+        self.generation = 0
+        self.seed = None
+        self.pids = []
+        self.pipes = []
+        self.rings = []
+        self.next_ring = 0
+        # generation the workers failed to mutate
+        self.failed = None
+        for i in range(workers):
+            ring = MutantRing(ring_size)
+            read_fd, write_fd = os.pipe()
+            # neither end goes to the fork server or the targets
+            for fd in (read_fd, write_fd):
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.detach(read_fd)
+                    self.work(read_fd, ring, seed + i, i * len(self.counter_names))
+                finally:
+                    os._exit(0)
+            os.close(read_fd)
+            self.pids.append(pid)
+            self.pipes.append(write_fd)
+            self.rings.append(ring)
+        atexit.register(self.close)
+
+    def detach(self, read_fd):
+        """Leaves a forked worker only its seed pipe and default signal handling."""
+        for signum in self.default_signals:
+            signal.signal(signum, signal.SIG_DFL)
+        try:
+            max_fd = os.sysconf('SC_OPEN_MAX')
+        except (ValueError, OSError):
+            max_fd = 1024
+        os.closerange(3, read_fd)
+        os.closerange(read_fd + 1, max_fd)
+
+    def work(self, read_fd, ring, seed, counter_base):
+        self.reseed(seed)
+        generation = None
+        buf = None
+        pending = None
+        idle = 0
+        while True:
+            # wait for a seed, for room in the ring, or just look for news
+            if buf is None:
+                timeout = None
+            elif pending is not None:
+                # the ring is full, back off while the fuzzer does not drain it
+                idle = min(max(idle * 2, self.min_delay), self.max_idle)
+                timeout = idle
+            else:
+                idle = 0
+                timeout = 0
+            if select.select([read_fd], [], [], timeout)[0]:
+                header = self.read(read_fd, self.message.size)
+                if header is None:
+                    return
+                generation, length = self.message.unpack(header)
+                if generation == self.stop_generation:
+                    return
+                buf = bytearray(self.read(read_fd, length) or b'')
+                pending = None
+            if buf is None:
+                continue
+            if pending is None:
+                try:
+                    pending = self.mutate(buf)
+                except Exception:
+                    # tell the fuzzer and wait for the next seed
+                    pending = None
+                    buf = None
+                    while not ring.put(generation, None):
+                        time.sleep(self.max_idle)
+                    continue
+                for k, name in enumerate(self.counter_names):
+                    self.counter_values[counter_base + k] = self.counters[name]
+            if ring.put(generation, pending):
+                pending = None
+
+    @staticmethod
+    def read(fd, length):
+        chunks = []
+        while length:
+            chunk = os.read(fd, length)
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def counter_totals(self):
+        """Returns the `counters` summed up over all workers that ever ran."""
+        totals = dict((name, 0) for name in self.counter_names)
+        if totals:
+            for i, value in enumerate(self.counter_values):
+                totals[self.counter_names[i % len(self.counter_names)]] += value
+        return totals
+
+    def alive(self):
+        for pid in self.pids:
+            try:
+                if os.waitpid(pid, os.WNOHANG) == (0, 0):
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def set_seed(self, buf):
+        """Starts a new generation of mutants of `buf` on all workers."""
+        self.generation = (self.generation + 1) % self.stop_generation
+        self.seed = bytes(buf)
+        message = self.message.pack(self.generation, len(self.seed)) + self.seed
+        for i in reversed(range(len(self.pipes))):
+            try:
+                os.write(self.pipes[i], message)
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                self.drop(i)
+
+    def drop(self, i):
+        """Forgets worker `i`, which has exited."""
+        os.close(self.pipes.pop(i))
+        pid = self.pids.pop(i)
+        self.rings.pop(i)
+        self.next_ring = 0
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def mutants(self, buf, n):
+        """
+        Returns `n` mutants of `buf` from the workers, mutating locally if
+        none of them is alive anymore.
+        """
+        if self.seed is None or self.seed != buf:
+            self.set_seed(buf)
+        if not self.rings or self.failed == self.generation:
+            return [self.mutate(bytearray(buf)) for _ in range(n)]
+        out = []
+        idle = 0
+        delay = self.min_delay
+        while len(out) < n:
+            ring = self.rings[self.next_ring]
+            self.next_ring = (self.next_ring + 1) % len(self.rings)
+            record = ring.get(self.generation)
+            if record is False:
+                # raises here as well if the seed is the problem
+                self.failed = self.generation
+                out += [self.mutate(bytearray(buf)) for _ in range(n - len(out))]
+                break
+            if record is not None:
+                out.append(record)
+                idle = 0
+                delay = self.min_delay
+                continue
+            idle += 1
+            if idle % len(self.rings) == 0:
+                # all rings empty, back off so the workers get the cores
+                if delay >= self.max_delay and not self.alive():
+                    out.append(self.mutate(bytearray(buf)))
+                    continue
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+        return out
+
+    def close(self):
+        message = self.message.pack(self.stop_generation, 0)
+        for fd in self.pipes:
+            try:
+                os.write(fd, message)
+                os.close(fd)
+            except OSError:
+                pass
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pipes = []
+        self.pids = []